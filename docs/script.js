@@ -1287,7 +1287,7 @@ async function sendChatMessage() {
         const { done, value } = await reader.read();
         if (done) break;
 
-        const chunk = decoder.decode(value);
+        const chunk = decoder.decode(value, { stream: true });  // 多位元組字元可能跨封包
         const lines = chunk.split('\n');
 
         for (const line of lines) {
@@ -1413,7 +1413,7 @@ async function autoExplainScore(analysis, overallScore) {
         const { done, value } = await reader.read();
         if (done) break;
 
-        const chunk = decoder.decode(value);
+        const chunk = decoder.decode(value, { stream: true });  // 多位元組字元可能跨封包
         const lines = chunk.split('\n');
 
         for (const line of lines) {
@@ -6,126 +6,128 @@ Google Sheets 題目讀取器
 import requests
 import json
 import re
+import csv
+import io
+import os
+import sys
+import functools
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import orjson  # 選用：序列化較快，未安裝時使用標準 json
+except ImportError:
+    orjson = None
 
 # Google Sheets URL
 SHEET_URL = "https://docs.google.com/spreadsheets/d/1XMDWl1EBJ2SGY6xviSBC7zk3jt4EV10jPGdAiJtflsA/export?format=csv&gid=0"
 
-def fetch_questions_from_sheet():
+# 資料列數達到此數量時才使用多行程解析（小型 Sheet 不值得啟動行程池）
+# 只在命令列執行時啟用；server.py 是多執行緒程式，在其中 fork 子行程可能造成死結
+PARALLEL_MIN_ROWS = 50
+
+# 本地題目檔案
+QUESTIONS_FILE = 'questions.json'
+
+# 下載的 CSV 快取（搭配 ETag / Last-Modified 做條件式請求）
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'vibecoding')
+CACHE_CSV_FILE = os.path.join(CACHE_DIR, 'questions.csv')
+CACHE_ETAG_FILE = CACHE_CSV_FILE + '.etag'
+# 多個執行緒可能同時下載，換上正式快取與寫入驗證標頭時需一起完成
+_cache_lock = threading.Lock()
+
+# 預先編譯的正規表達式（每一行都會用到）
+_TASK_RE = re.compile(r'Task\s*(\d+)[：:]\s*(.+)')
+_PAREN_STRIP_RE = re.compile(r'（[^）]*）')
+_PAREN_CAP_RE = re.compile(r'（([^）]+)）')
+_CASE_SPLIT_RE = re.compile(r'[、,，]')
+
+# 測資中要移除的特殊字符（\r、\t、不換行空白）
+_CTRL_TRANS = str.maketrans('', '', '\r\t\xa0')
+
+# 題目編號對應的難度（未列出的編號預設為「入門」）
+# 中文字串不會被自動 intern，這裡手動 intern 讓所有題目共用同一個字串物件
+_DIFFICULTY_BY_ID = {task_id: sys.intern(level) for task_id, level in {
+    '1': '入門',
+    '2': '初級',
+    '3': '中級',
+    '4': '中級'
+}.items()}
+_DEFAULT_DIFFICULTY = _DIFFICULTY_BY_ID['1']
+
+# 關鍵字對應的學習目標（依序比對）
+_KEYWORD_GOALS = tuple((keyword, tuple(sys.intern(goal) for goal in goals)) for keyword, goals in (
+    ('字串', ('理解字串操作', '掌握字串方法')),
+    ('數字', ('理解數值運算', '掌握算術運算子')),
+    ('輸入', ('掌握 input() 函數', '理解資料型別轉換')),
+    ('總和', ('理解迴圈累加', '掌握 for 迴圈')),
+    ('最大值', ('掌握條件判斷', '理解比較運算子')),
+    ('比較', ('理解邏輯運算', '掌握 if-elif-else')),
+    ('反轉', ('理解字串切片', '掌握字串索引')),
+    ('回文', ('理解對稱判斷邏輯', '掌握字串比較')),
+    ('數列', ('理解串列操作', '掌握 list 資料結構')),
+    ('平均', ('掌握統計計算', '理解 sum() 和 len()'))
+))
+
+# 沒有匹配到任何關鍵字時的通用目標
+_DEFAULT_GOALS = tuple(sys.intern(goal) for goal in ('理解基礎 Python 語法', '掌握程式邏輯思維'))
+
+# 將所有關鍵字合併成單一正規表達式，掃描一次標題即可找出所有出現的關鍵字
+# （包在 lookahead 中，彼此重疊的關鍵字也能同時被找到）
+_KEYWORD_RE = re.compile('(?=(' + '|'.join(re.escape(keyword) for keyword, _ in _KEYWORD_GOALS) + '))')
+
+def fetch_questions_from_sheet(parallel=False):
     """
     從 Google Sheets 讀取題目資料
+    parallel: 資料量大時是否用多個行程解析（僅供命令列使用）
     返回題目列表
     """
     try:
-        # 下載 CSV 資料
-        response = requests.get(SHEET_URL, timeout=10)
-        response.encoding = 'utf-8'
+        # 如果有上次下載的快取，帶上驗證標頭；Sheet 未變更時伺服器會回傳 304
+        validators = load_cache_validators()
+        request_headers = {}
+        if validators.get('ETag'):
+            request_headers['If-None-Match'] = validators['ETag']
+        if validators.get('Last-Modified'):
+            request_headers['If-Modified-Since'] = validators['Last-Modified']
         
-        if response.status_code != 200:
-            print(f"❌ 無法訪問 Google Sheets: HTTP {response.status_code}")
-            return None
+        # 以串流方式下載 CSV 資料，邊下載邊解析
+        response = requests.get(SHEET_URL, headers=request_headers, stream=True, timeout=10)
         
-        # 解析 CSV
-        lines = response.text.strip().split('\n')
-        
-        if len(lines) < 2:
-            print("❌ Sheet 資料格式錯誤")
-            return None
-        
-        # 解析標題行
-        headers = parse_csv_line(lines[0])
-        print(f"📋 欄位: {headers}")
-        
-        # 解析資料行
-        questions = []
-        for i, line in enumerate(lines[1:], start=2):
-            if not line.strip():
-                continue
+        with response:
+            if response.status_code == 304:
+                print("♻️  Sheet 未變更，使用本地快取")
+                return load_cached_questions(parallel)
+            
+            if response.status_code != 200:
+                print(f"❌ 無法訪問 Google Sheets: HTTP {response.status_code}")
+                return None
+            
+            # 解析 CSV（使用標準函式庫的 csv 模組處理雙引號和逗號）
+            # 直接讀取原始串流，不必先把整份回應轉成字串再切行
+            response.raw.decode_content = True
+            text_stream = io.TextIOWrapper(response.raw, encoding='utf-8', newline='')
             
+            # 解析的同時把 CSV 寫入本地快取（每次下載使用各自的暫存檔）
+            cache = open_cache_writer()
+            if cache is None:
+                return parse_questions_csv(csv.reader(text_stream), parallel)
+            
+            cache_file, tmp_path = cache
             try:
-                values = parse_csv_line(line)
-                
-                # 確保欄位數量一致
-                while len(values) < len(headers):
-                    values.append('')
-                
-                # 獲取原始資料（新的欄位結構）
-                task_info = values[0] if len(values) > 0 else ''
-                description = values[1] if len(values) > 1 else ''
-                example_image = values[2] if len(values) > 2 else ''  # 示例圖片在第3欄
-                # 舊的 test_data 欄位已不存在
-                test_data = ''
-                
-                # 解析任務編號和主題
-                task_match = re.match(r'Task\s*(\d+)[：:]\s*(.+)', task_info)
-                if task_match:
-                    task_id = task_match.group(1)
-                    task_title = task_match.group(2).strip()
-                else:
-                    task_id = str(i - 1)
-                    task_title = task_info
+                with cache_file:
+                    questions = parse_questions_csv(csv.reader(tee_lines(text_stream, cache_file)), parallel)
                 
-                # 清理描述（移除括號內的提示）
-                clean_description = re.sub(r'（[^）]*）', '', description).strip()
-                if not clean_description:
-                    clean_description = description
-                
-                # 提取括號內的提示作為 hints（保留供後續使用）
-                hints_from_desc = re.findall(r'（([^）]+)）', description)
-                
-                # 處理示例圖片 URL
-                example_image_url = example_image.strip() if example_image else ''
-                
-                # 解析測資為預期輸出範例
-                test_cases = []
-                if test_data:
-                    # 移除「\r」等特殊字符
-                    test_data = test_data.replace('\r', '').strip()
-                    # 分割測試案例
-                    cases = re.split(r'[、,，]', test_data)
-                    for case in cases:
-                        case = case.strip()
-                        if case and '→' in case:
-                            input_part, output_part = case.split('→', 1)
-                            test_cases.append({
-                                'input': input_part.strip(),
-                                'output': output_part.strip()
-                            })
-                
-                # 根據題目類型給予難度
-                difficulty = '入門'
-                if 'Task 3' in task_info or 'Task 4' in task_info:
-                    difficulty = '中級'
-                elif 'Task 1' in task_info:
-                    difficulty = '入門'
-                elif 'Task 2' in task_info:
-                    difficulty = '初級'
-                
-                # 構建題目物件
-                question = {
-                    'id': task_id,
-                    'title': task_title,
-                    'description': clean_description,
-                    'difficulty': difficulty,
-                    'test_cases': test_cases,
-                    'hints': hints_from_desc,  # 保留 hints（從描述提取）
-                    'example_image': example_image_url,  # 新增：示例圖片
-                    'learning_goals': extract_learning_goals(task_title),
-                    'original_data': {
-                        'task_info': task_info,
-                        'description': description,
-                        'test_data': test_data,
-                        'example_image': example_image
-                    }
-                }
-                
-                questions.append(question)
-                
-            except Exception as e:
-                print(f"⚠️  第 {i} 行解析失敗: {str(e)}")
-                continue
-        
-        print(f"✅ 成功讀取 {len(questions)} 道題目")
-        return questions
+                if questions:
+                    save_cache(tmp_path, response.headers)
+            finally:
+                # 解析失敗或沒有題目時刪除暫存檔（已換成正式快取時檔案已不存在）
+                try:
+                    os.remove(tmp_path)
+                except FileNotFoundError:
+                    pass
+            return questions
         
     except requests.exceptions.RequestException as e:
         print(f"❌ 網路請求失敗: {str(e)}")
@@ -134,121 +136,256 @@ def fetch_questions_from_sheet():
         print(f"❌ 讀取失敗: {str(e)}")
         return None
 
-def parse_csv_line(line):
+def parse_questions_csv(reader, parallel=False):
     """
-    解析 CSV 行（處理雙引號和逗號）
+    將 csv.reader 產生的資料列轉換為題目列表
+    parallel: 資料列數達到 PARALLEL_MIN_ROWS 時分散到多個行程處理
     """
-    values = []
-    current = ""
-    in_quotes = False
+    # 解析標題行
+    headers = next(reader, None)
+    if not headers:
+        print("❌ Sheet 資料格式錯誤")
+        return None
+    print(f"📋 欄位: {headers}")
     
-    i = 0
-    while i < len(line):
-        char = line[i]
-        
-        if char == '"':
-            if in_quotes and i + 1 < len(line) and line[i + 1] == '"':
-                # 雙引號轉義
-                current += '"'
-                i += 2
-                continue
-            else:
-                # 切換引號狀態
-                in_quotes = not in_quotes
-                i += 1
-                continue
-        
-        if char == ',' and not in_quotes:
-            # 欄位分隔
-            values.append(current)
-            current = ""
-            i += 1
+    # 過濾空白列並補齊欄位
+    rows = []
+    for i, values in enumerate(reader, start=2):
+        if not any(value.strip() for value in values):
             continue
         
-        current += char
-        i += 1
+        # 確保欄位數量一致
+        while len(values) < len(headers):
+            values.append('')
+        
+        rows.append((i, values))
     
-    # 添加最後一個欄位
-    values.append(current)
+    # 各列之間互不相依，資料量大時分散到多個行程處理
+    if not parallel or len(rows) < PARALLEL_MIN_ROWS:
+        questions = [build_question(row) for row in rows]
+    else:
+        workers = os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            questions = list(executor.map(build_question, rows, chunksize=max(1, len(rows) // (workers * 4))))
     
-    return values
+    print(f"✅ 成功讀取 {len(questions)} 道題目")
+    return questions
 
+def build_question(row):
+    """
+    將單一資料列轉換為題目物件
+    row: (行號, 欄位列表)
+    """
+    i, values = row
+    
+    # 獲取原始資料（新的欄位結構）
+    task_info = values[0] if len(values) > 0 else ''
+    description = values[1] if len(values) > 1 else ''
+    example_image = values[2] if len(values) > 2 else ''  # 示例圖片在第3欄
+    # 舊的 test_data 欄位已不存在
+    test_data = ''
+    
+    # 解析任務編號和主題
+    task_match = _TASK_RE.match(task_info)
+    if task_match:
+        task_id = task_match.group(1)
+        task_title = task_match.group(2).strip()
+    else:
+        task_id = str(i - 1)
+        task_title = task_info
+    
+    # 清理描述（移除括號內的提示）
+    clean_description = _PAREN_STRIP_RE.sub('', description).strip()
+    if not clean_description:
+        clean_description = description
+    
+    # 提取括號內的提示作為 hints（保留供後續使用）
+    hints_from_desc = _PAREN_CAP_RE.findall(description)
+    
+    # 處理示例圖片 URL
+    example_image_url = example_image.strip() if example_image else ''
+    
+    # 解析測資為預期輸出範例
+    test_cases = []
+    if test_data:
+        # 移除「\r」等特殊字符
+        test_data = test_data.translate(_CTRL_TRANS).strip()
+        # 分割測試案例
+        cases = _CASE_SPLIT_RE.split(test_data)
+        for case in cases:
+            case = case.strip()
+            if case and '→' in case:
+                input_part, output_part = case.split('→', 1)
+                test_cases.append({
+                    'input': input_part.strip(),
+                    'output': output_part.strip()
+                })
+    
+    # 根據題目編號給予難度（沒有「Task N：」標題的資料列一律為預設難度，行號不代表題目編號）
+    if task_match:
+        difficulty = _DIFFICULTY_BY_ID.get(task_id, _DEFAULT_DIFFICULTY)
+    else:
+        difficulty = _DEFAULT_DIFFICULTY
+    
+    # 構建題目物件
+    return {
+        'id': task_id,
+        'title': task_title,
+        'description': clean_description,
+        'difficulty': difficulty,
+        'test_cases': test_cases,
+        'hints': hints_from_desc,  # 保留 hints（從描述提取）
+        'example_image': example_image_url,  # 新增：示例圖片
+        'learning_goals': list(extract_learning_goals(task_title))
+    }
+
+def load_cache_validators():
+    """
+    讀取上次下載時保存的 ETag / Last-Modified
+    快取檔案不完整時返回空字典
+    """
+    if not (os.path.exists(CACHE_CSV_FILE) and os.path.exists(CACHE_ETAG_FILE)):
+        return {}
+    
+    try:
+        with open(CACHE_ETAG_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def open_cache_writer():
+    """
+    建立專屬的暫存檔以寫入下載中的 CSV，返回 (檔案, 路徑)
+    無法寫入時返回 None（不影響題目讀取）
+    """
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, prefix='questions.csv.', suffix='.tmp')
+        return os.fdopen(fd, 'w', encoding='utf-8', newline=''), tmp_path
+    except OSError as e:
+        print(f"⚠️  無法寫入本地快取: {str(e)}")
+        return None
+
+def tee_lines(lines, cache_file):
+    """
+    逐行轉交給 csv.reader，同時寫入快取檔案
+    """
+    for line in lines:
+        cache_file.write(line)
+        yield line
+
+def save_cache(tmp_path, response_headers):
+    """
+    將暫存檔換成正式快取，並保存驗證標頭
+    """
+    validators = {
+        name: response_headers[name]
+        for name in ('ETag', 'Last-Modified')
+        if response_headers.get(name)
+    }
+    
+    try:
+        with _cache_lock:
+            os.replace(tmp_path, CACHE_CSV_FILE)
+            with open(CACHE_ETAG_FILE, 'w', encoding='utf-8') as f:
+                json.dump(validators, f)
+    except OSError as e:
+        print(f"⚠️  無法寫入本地快取: {str(e)}")
+
+def load_cached_questions(parallel=False):
+    """
+    Sheet 未變更時從本地讀取題目
+    如果 questions.json 比快取的 CSV 新，直接使用它而不必重新解析
+    """
+    if os.path.exists(QUESTIONS_FILE) and os.path.getmtime(QUESTIONS_FILE) >= os.path.getmtime(CACHE_CSV_FILE):
+        with open(QUESTIONS_FILE, 'r', encoding='utf-8') as f:
+            questions = json.load(f)
+        print(f"✅ 從 {QUESTIONS_FILE} 讀取 {len(questions)} 道題目")
+        return questions
+    
+    with open(CACHE_CSV_FILE, 'r', encoding='utf-8', newline='') as f:
+        return parse_questions_csv(csv.reader(f), parallel)
+
+@functools.lru_cache(maxsize=512)
 def extract_learning_goals(title):
     """
     根據題目標題提取學習目標
+    結果會被快取，因此返回不可變的 tuple
     """
     goals = []
     
-    # 根據關鍵字判斷學習目標
-    keywords_map = {
-        '字串': ['理解字串操作', '掌握字串方法'],
-        '數字': ['理解數值運算', '掌握算術運算子'],
-        '輸入': ['掌握 input() 函數', '理解資料型別轉換'],
-        '總和': ['理解迴圈累加', '掌握 for 迴圈'],
-        '最大值': ['掌握條件判斷', '理解比較運算子'],
-        '比較': ['理解邏輯運算', '掌握 if-elif-else'],
-        '反轉': ['理解字串切片', '掌握字串索引'],
-        '回文': ['理解對稱判斷邏輯', '掌握字串比較'],
-        '數列': ['理解串列操作', '掌握 list 資料結構'],
-        '平均': ['掌握統計計算', '理解 sum() 和 len()']
-    }
-    
-    for keyword, goal_list in keywords_map.items():
-        if keyword in title:
+    # 根據關鍵字判斷學習目標（依表格順序加入，收集到 3 個就停止）
+    found = set(_KEYWORD_RE.findall(title))
+    for keyword, goal_list in _KEYWORD_GOALS:
+        if keyword in found:
             goals.extend(goal_list)
+            if len(goals) >= 3:
+                break
     
     # 如果沒有匹配到，給一個通用目標
     if not goals:
-        goals = ['理解基礎 Python 語法', '掌握程式邏輯思維']
+        return _DEFAULT_GOALS
     
-    return goals[:3]  # 最多返回3個目標
+    return tuple(goals[:3])  # 最多返回3個目標
 
 
-def save_questions_to_file(questions, filename='questions.json'):
+def save_questions_to_file(questions, filename=QUESTIONS_FILE):
     """
     將題目儲存到 JSON 檔案
     """
     try:
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(questions, f, ensure_ascii=False, indent=2)
+        if orjson is not None:
+            with open(filename, 'wb') as f:
+                f.write(orjson.dumps(questions, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+        else:
+            with open(filename, 'w', encoding='utf-8') as f:
+                json.dump(questions, f, ensure_ascii=False, indent=2)
         print(f"✅ 題目已儲存到 {filename}")
         return True
     except Exception as e:
         print(f"❌ 儲存失敗: {str(e)}")
         return False
 
-def print_questions_summary(questions):
+def print_questions_summary(questions, verbose=True):
     """
     列印題目摘要
+    verbose: 為 False 時不列印每道題目的詳細內容
     """
     if not questions:
         print("❌ 沒有題目資料")
         return
     
+    if not verbose:
+        return
+    
     print("\n" + "=" * 60)
     print("📚 題目列表")
     print("=" * 60)
     
     for i, q in enumerate(questions, start=1):
         print(f"\n【題目 {i}】")
-        print(f"  ID: {q.get('id', 'N/A')}")
-        print(f"  標題: {q.get('title', 'N/A')}")
-        print(f"  難度: {q.get('difficulty', 'N/A')}")
-        print(f"  描述: {q.get('description', 'N/A')[:60]}...")
+        # build_question 產生的欄位一定存在，直接取值
+        print(f"  ID: {q['id']}")
+        print(f"  標題: {q['title']}")
+        print(f"  難度: {q['difficulty']}")
+        print(f"  描述: {q['description'][:60]}...")
         
-        if 'test_cases' in q and q['test_cases']:
-            print(f"  測試案例: {len(q['test_cases'])} 組")
-            for j, tc in enumerate(q['test_cases'][:2], start=1):
+        test_cases = q['test_cases']
+        if test_cases:
+            print(f"  測試案例: {len(test_cases)} 組")
+            for j, tc in enumerate(test_cases[:2], start=1):
                 print(f"    {j}. 輸入: {tc['input']} → 輸出: {tc['output']}")
         
-        if 'learning_goals' in q and q['learning_goals']:
+        if q['learning_goals']:
             print(f"  學習目標: {', '.join(q['learning_goals'][:2])}")
         
-        if 'hints' in q and q['hints']:
+        if q['hints']:
             print(f"  提示: {len(q['hints'])} 項")
         
-        if 'example_image' in q and q['example_image']:
-            print(f"  示例圖片: {q['example_image'][:50]}..." if len(q['example_image']) > 50 else f"  示例圖片: {q['example_image']}")
+        # 舊版 questions.json 可能沒有示例圖片欄位
+        example_image = q.get('example_image')
+        if example_image:
+            print(f"  示例圖片: {example_image[:50]}..." if len(example_image) > 50 else f"  示例圖片: {example_image}")
     
     print("\n" + "=" * 60)
 
@@ -258,11 +395,11 @@ if __name__ == "__main__":
     print()
     
     # 讀取題目
-    questions = fetch_questions_from_sheet()
+    questions = fetch_questions_from_sheet(parallel=True)
     
     if questions:
-        # 列印摘要
-        print_questions_summary(questions)
+        # 列印摘要（輸出被導向檔案或管線時略過，可設定 VERBOSE 強制列印）
+        print_questions_summary(questions, verbose=sys.stdout.isatty() or bool(os.environ.get('VERBOSE')))
         
         # 儲存到檔案
         save_questions_to_file(questions)
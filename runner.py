@@ -0,0 +1,182 @@
+"""
+程式碼沙箱執行器
+由 server.py 以獨立子行程啟動（python -I -S runner.py），從 stdin 讀取 marshal 資料：
+    {"code": <code object>, "inputs": [...], "limits": {"RLIMIT_CPU": 6, ...}}
+執行完畢後將 {"output": ..., "error": ...} 以 JSON 寫到 stdout。
+此檔案只能依賴標準函式庫，子行程以隔離模式啟動，無法導入專案內其他模組。
+"""
+
+import builtins
+import contextlib
+import io
+import json
+import marshal
+import sys
+
+try:
+    import resource  # 僅 POSIX 系統提供，Windows 上不設定資源上限
+except ImportError:
+    resource = None
+
+MAX_OUTPUT_LENGTH = 10000  # 最大輸出長度
+
+# 允許的內建函數白名單
+SAFE_BUILTINS = {
+    'print': print,
+    'len': len,
+    'str': str,
+    'int': int,
+    'float': float,
+    'bool': bool,
+    'list': list,
+    'dict': dict,
+    'tuple': tuple,
+    'set': set,
+    'range': range,
+    'enumerate': enumerate,
+    'zip': zip,
+    'sum': sum,
+    'min': min,
+    'max': max,
+    'abs': abs,
+    'round': round,
+    'sorted': sorted,
+    'reversed': reversed,
+    'type': type,
+    'isinstance': isinstance,
+    'hasattr': hasattr,
+    'getattr': getattr,
+    'chr': chr,
+    'ord': ord,
+    'bin': bin,
+    'hex': hex,
+    'oct': oct,
+    'pow': pow,
+    'divmod': divmod,
+    'all': all,
+    'any': any,
+    'filter': filter,
+    'map': map,
+    # 數學函數
+    'complex': complex,
+    # 添加安全的 __import__ 實現
+    '__import__': __import__,  # 我們會用自定義的安全版本替換
+    # 不包含危險函數: open, exec, eval, compile, globals, locals, vars, dir
+}
+
+# 允許的模組白名單
+ALLOWED_MODULES = frozenset({
+    'math',
+    'random',
+    'datetime',
+    'decimal',
+    'fractions',
+    'statistics',
+    'string',
+    'json',
+    're'  # 正則表達式，但會限制某些功能
+})
+
+def safe_import(name, globals=None, locals=None, fromlist=(), level=0):
+    """
+    安全的模組導入函數，只允許導入白名單中的模組
+    """
+    if name not in ALLOWED_MODULES:
+        raise ImportError(f"不允許導入模組: {name}")
+    
+    # 使用原始的 __import__ 導入允許的模組
+    return builtins.__import__(name, globals, locals, fromlist, level)
+
+def create_safe_input(input_queue):
+    """
+    創建安全的 input 函數，從預先提供的輸入佇列中讀取
+    """
+    remaining = iter(input_queue)
+    
+    def safe_input(prompt=''):
+        try:
+            value = next(remaining)
+        except StopIteration:
+            raise EOFError('沒有更多輸入資料') from None
+        # 如果有提示訊息，也輸出它（模擬真實 input 行為）
+        if prompt:
+            print(prompt, end='')
+        print(value)  # 輸出輸入的值（模擬使用者輸入）
+        return value
+    
+    return safe_input
+
+# 預先建好的內建函數模板（已換上安全導入函數），每次執行只需複製並加入 input
+_BUILTINS_TEMPLATE = dict(SAFE_BUILTINS)
+_BUILTINS_TEMPLATE['__import__'] = safe_import
+
+def apply_resource_limits(limits):
+    """
+    設定子行程自身的資源上限（CPU 秒數、記憶體、檔案描述符）
+    在執行學生程式碼之前呼叫，之後即無法再調高
+    """
+    if resource is None or not limits:
+        return
+    
+    for name, value in limits.items():
+        limit = getattr(resource, name, None)
+        if limit is None:
+            continue
+        _, hard = resource.getrlimit(limit)
+        if hard != resource.RLIM_INFINITY:
+            value = min(value, hard)
+        resource.setrlimit(limit, (value, value))
+
+def run_code(code, inputs):
+    """
+    在受限的內建函數環境中執行已編譯的程式碼，回傳 {'output': ..., 'error': ...}
+    """
+    result = {'output': '', 'error': None}
+    
+    try:
+        # 創建安全的執行環境
+        safe_builtins = _BUILTINS_TEMPLATE.copy()
+        # 添加安全的 input 函數
+        safe_builtins['input'] = create_safe_input(inputs)
+        safe_globals = {
+            '__builtins__': safe_builtins,
+            '__name__': '__main__',
+        }
+        
+        safe_locals = {}
+        
+        # 重新導向輸出
+        output_buffer = io.StringIO()
+        error_buffer = io.StringIO()
+        
+        with contextlib.redirect_stdout(output_buffer), contextlib.redirect_stderr(error_buffer):
+            exec(code, safe_globals, safe_locals)
+        
+        output = output_buffer.getvalue()
+        errors = error_buffer.getvalue()
+        
+        # 限制輸出長度
+        if len(output) > MAX_OUTPUT_LENGTH:
+            output = output[:MAX_OUTPUT_LENGTH] + '\n...(輸出被截斷)'
+        
+        if errors:
+            output = output + '\n' + errors if output else errors
+        
+        result['output'] = output if output else '(程式執行成功，無輸出)'
+        
+    except Exception as e:
+        # MemoryError 等例外沒有訊息，改用例外名稱避免被當成執行成功
+        result['error'] = str(e) or type(e).__name__
+    
+    return result
+
+def main():
+    payload = marshal.loads(sys.stdin.buffer.read())
+    apply_resource_limits(payload.get('limits'))
+    result = run_code(payload['code'], payload.get('inputs') or [])
+    # 以 ASCII JSON 輸出，避免子行程的 stdout 編碼設定影響結果
+    sys.stdout.buffer.write(json.dumps(result).encode('ascii'))
+    sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
@@ -1,35 +1,122 @@
 from flask import Flask, request, jsonify, session, Response
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 import sys
-import io
-import contextlib
+import subprocess
 import secrets
 from datetime import datetime
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 import ast
 import signal
 import threading
 import time
+import atexit
+import random
 import re
 import json
+import itertools
+import functools
+import marshal
+import hashlib
+import string
+import queue
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import jinja2
 import google.generativeai as genai
+from google.generativeai import client as genai_client
+from google.api_core.exceptions import ResourceExhausted, DeadlineExceeded, ServiceUnavailable
 import os
+import requests
+from requests.adapters import HTTPAdapter
 import gspread
 from google.oauth2.service_account import Credentials
 
+try:
+    import orjson  # 選用：序列化較快，未安裝時使用標準 json
+except ImportError:
+    orjson = None
+
+# 成績讀寫路徑的日誌：請求執行緒只把紀錄放進佇列，由背景執行緒輸出到 stdout
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logger.propagate = False
+_log_queue = queue.SimpleQueue()
+logger.addHandler(QueueHandler(_log_queue))
+_log_listener = QueueListener(_log_queue, logging.StreamHandler(sys.stdout))
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+class OrjsonJSONProvider(DefaultJSONProvider):
+    """
+    以 orjson 處理 jsonify 與 request.get_json，未安裝 orjson 時沿用 Flask 預設行為
+    datetime 交給 Flask 的 default 轉成 HTTP 日期格式，輸出與預設相同
+    """
+    options = (orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS) if orjson else 0
+    
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self.options).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+        # 直接輸出 bytes，省去 str 與重新編碼
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default, option=self.options),
+            mimetype=self.mimetype
+        )
+
+def load_json_file(path):
+    """
+    讀取 JSON 檔案，有 orjson 時直接解析原始 bytes
+    """
+    if orjson is not None:
+        with open(path, 'rb') as f:
+            return orjson.loads(f.read())
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def dump_json_bytes(data):
+    """
+    序列化成縮排 2 格的 UTF-8 JSON bytes（中文不跳脫），用於寫入本地檔案
+    """
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8')
+
+def dump_json_line(data):
+    """
+    序列化成單行 UTF-8 JSON（含結尾換行），用於 JSONL 檔案
+    """
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS) + b'\n'
+    return json.dumps(data, ensure_ascii=False).encode('utf-8') + b'\n'
+
 app = Flask(__name__)
+app.json = OrjsonJSONProvider(app)
 app.secret_key = secrets.token_hex(16)  # 生成隨機密鑰
 CORS(app, supports_credentials=True)  # 允許跨域請求並支援 cookie
 
 # 導入題目讀取器
-from fetch_questions import fetch_questions_from_sheet
+from fetch_questions import fetch_questions_from_sheet, save_questions_to_file
+# 導入沙箱共用的模組白名單（實際執行於 runner.py 子行程）
+from runner import ALLOWED_MODULES
 
 # 載入提示詞配置
 prompts_config = {}
 try:
     if os.path.exists('prompts.json'):
-        with open('prompts.json', 'r', encoding='utf-8') as f:
-            prompts_config = json.load(f)
-            print('✅ 提示詞配置載入成功')
+        prompts_config = load_json_file('prompts.json')
+        print('✅ 提示詞配置載入成功')
     else:
         print('⚠️  警告：prompts.json 不存在，將使用預設提示詞')
 except Exception as e:
@@ -37,8 +124,14 @@ except Exception as e:
 
 # 題目快取
 questions_cache = None
+questions_by_id = {}  # {str(id): 題目}，與 questions_cache 同步更新
+_questions_version = 0  # 每次更新題目快取時遞增，讓標題快取失效
 questions_last_fetch = None
-CACHE_EXPIRE_MINUTES = 30  # 快取 30 分鐘
+CACHE_EXPIRE_MINUTES = 30  # 快取 30 分鐘（過期後 30 分鐘內先回傳舊資料並在背景刷新）
+CACHE_PREFETCH_RATIO = 0.9  # 快取使用超過 90% 時間就提前在背景刷新
+questions_refresh_in_flight = False
+questions_refresh_lock = threading.Lock()
+_questions_lock = threading.RLock()  # 更新題目快取時持有；讀取端只複製參考，不需上鎖
 
 # Google Sheets 成績記錄配置
 SCORES_SPREADSHEET_ID = '1LyKMeDqbsVzEdx7q2ArTngCM5s02gtp27cv_v1wEOVI'
@@ -47,6 +140,14 @@ SCORES_SHEET_URL = f'https://docs.google.com/spreadsheets/d/{SCORES_SPREADSHEET_
 # Google Apps Script Web App URL (用於寫入成績)
 WEBAPP_URL = 'https://script.google.com/macros/s/AKfycbzLPGUzL1HnRkSgEua3TZO4zildeJ2cQGuihgY4HXYPSYxD4-b7kf1maMNBimDdjoMEdQ/exec'
 
+# 共用的 HTTP 連線（保持 keep-alive，成績讀寫不必每次重新建立 TCP/TLS 連線）
+http_session = requests.Session()
+http_session.mount('https://', HTTPAdapter(pool_connections=8, pool_maxsize=32))
+
+# 背景 I/O 執行緒池（成績寫入 Google Sheets 時與本地備份同時進行）
+_IO_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix='io')
+WEBAPP_JOIN_TIMEOUT = 12  # 等待 Google Sheets 寫入的秒數（HTTP timeout 10 秒 + 緩衝）
+
 # Google Sheets 客戶端（使用服務帳號或 API Key）
 gspread_client = None
 
@@ -75,34 +176,67 @@ def init_gspread_client():
 # 初始化 Google Sheets 客戶端
 init_gspread_client()
 
+# config.json 快取（每隔一段時間才檢查檔案修改時間，避免每次請求都讀檔）
+CONFIG_FILE = 'config.json'
+CONFIG_RECHECK_SECONDS = 10
+_config_cache = {'mtime': None, 'checked_at': 0.0, 'data': {}}
+
+def _get_config():
+    """
+    取得 config.json 內容，檔案未變更時直接回傳快取的字典
+    """
+    now = time.monotonic()
+    if now - _config_cache['checked_at'] < CONFIG_RECHECK_SECONDS:
+        return _config_cache['data']
+    _config_cache['checked_at'] = now
+    
+    try:
+        mtime = os.stat(CONFIG_FILE).st_mtime
+    except OSError:
+        _config_cache['mtime'] = None
+        _config_cache['data'] = {}
+        return _config_cache['data']
+    
+    if mtime != _config_cache['mtime']:
+        try:
+            _config_cache['data'] = load_json_file(CONFIG_FILE)
+            _config_cache['mtime'] = mtime
+        except (OSError, ValueError) as e:
+            # 檔案寫到一半或格式錯誤時保留舊設定，下次檢查再重試
+            print(f'⚠️  無法讀取 {CONFIG_FILE}: {str(e)}')
+    
+    return _config_cache['data']
+
 # API Key 輪替機制
 api_keys_list = []
-current_key_index = 0
-api_key_lock = threading.Lock()
+_key_iter = None  # 以 itertools.cycle 輪替，next() 在 GIL 下是單一 C 層操作，不需加鎖
+api_key_lock = threading.Lock()  # 只在重建 API Key 列表時使用
+
+def _set_api_keys(keys):
+    """更新 API Key 列表並重建輪替迭代器"""
+    global api_keys_list, _key_iter
+    with api_key_lock:
+        api_keys_list = keys
+        _key_iter = itertools.cycle(keys) if keys else None
 
 def load_api_keys():
     """載入並過濾有效的 API Keys"""
-    global api_keys_list
     try:
         # 優先從 api_keys.json 載入
         if os.path.exists('api_keys.json'):
-            with open('api_keys.json', 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                # 過濾掉空的 key
-                api_keys_list = [item['key'] for item in data.get('api_keys', []) if item.get('key', '').strip()]
-                if api_keys_list:
-                    print(f'✅ 已載入 {len(api_keys_list)} 個有效的 API Keys')
-                    return True
+            data = load_json_file('api_keys.json')
+            # 過濾掉空的 key
+            _set_api_keys([item['key'] for item in data.get('api_keys', []) if item.get('key', '').strip()])
+            if api_keys_list:
+                print(f'✅ 已載入 {len(api_keys_list)} 個有效的 API Keys')
+                return True
         
         # 如果 api_keys.json 不存在或為空，嘗試從 config.json 載入
-        if os.path.exists('config.json'):
-            with open('config.json', 'r', encoding='utf-8') as f:
-                config = json.load(f)
-                key = config.get('gemini_api_key', '').strip()
-                if key:
-                    api_keys_list = [key]
-                    print('✅ 從 config.json 載入 1 個 API Key')
-                    return True
+        key = _get_config().get('gemini_api_key', '').strip()
+        if key:
+            _set_api_keys([key])
+            print('✅ 從 config.json 載入 1 個 API Key')
+            return True
         
         print('⚠️  警告：未找到有效的 API Keys')
         return False
@@ -111,17 +245,57 @@ def load_api_keys():
         print(f'❌ 載入 API Keys 失敗: {str(e)}')
         return False
 
+# 配額用盡的 API Key 暫停使用的秒數
+KEY_COOLDOWN_SECONDS = 60
+_key_cooldowns = {}  # {api_key: 可再次使用的時間 (time.monotonic)}
+
+def mark_key_cooldown(api_key):
+    """將配額用盡的 API Key 標記為冷卻中"""
+    _key_cooldowns[api_key] = time.monotonic() + KEY_COOLDOWN_SECONDS
+
 def get_next_api_key():
-    """輪流取得下一個 API Key（Thread-safe）"""
-    global current_key_index
-    
-    if not api_keys_list:
+    """輪流取得下一個 API Key（Thread-safe），略過冷卻中的 Key；全部冷卻中時回傳 None"""
+    key_iter = _key_iter
+    if key_iter is None:
         return None
     
-    with api_key_lock:
-        key = api_keys_list[current_key_index]
-        current_key_index = (current_key_index + 1) % len(api_keys_list)
+    key = next(key_iter)
+    if not _key_cooldowns:
         return key
+    
+    now = time.monotonic()
+    for _ in range(len(api_keys_list)):
+        if _key_cooldowns.get(key, 0) <= now:
+            return key
+        key = next(key_iter)
+    
+    return None
+
+# 換一個 API Key 重試可能成功的 Gemini 錯誤（配額用盡、逾時、服務暫時無法使用）
+RETRYABLE_GEMINI_ERRORS = (ResourceExhausted, DeadlineExceeded, ServiceUnavailable)
+
+# 已建立的 Gemini Model（以 API Key 與模型名稱為鍵），避免每次請求重新建立
+gemini_model_pool = {}
+gemini_model_pool_lock = threading.Lock()
+
+def get_model_for_key(api_key, model_name):
+    """取得綁定指定 API Key 的 Gemini Model（第一次使用時建立並快取）"""
+    pool_key = (api_key, model_name)
+    model = gemini_model_pool.get(pool_key)
+    if model is not None:
+        return model
+    
+    with gemini_model_pool_lock:
+        model = gemini_model_pool.get(pool_key)
+        if model is None:
+            genai.configure(api_key=api_key)
+            model = genai.GenerativeModel(model_name)
+            # SDK 預設在第一次呼叫時才取用全域 client，這裡立即綁定，
+            # 之後其他 Key 重新 configure 也不會改變這個 model 使用的 Key
+            model._client = genai_client.get_default_generative_client()
+            gemini_model_pool[pool_key] = model
+    
+    return model
 
 def get_gemini_model_with_retry(max_retries=None):
     """
@@ -135,12 +309,8 @@ def get_gemini_model_with_retry(max_retries=None):
     if max_retries is None:
         max_retries = len(api_keys_list)
     
-    # 從 config.json 讀取模型名稱
-    model_name = 'gemini-1.5-flash'  # 預設使用 1.5-flash（穩定版本，配額較高）
-    if os.path.exists('config.json'):
-        with open('config.json', 'r', encoding='utf-8') as f:
-            config = json.load(f)
-            model_name = config.get('model_name', model_name)
+    # 從 config.json 讀取模型名稱（預設使用 1.5-flash：穩定版本，配額較高）
+    model_name = _get_config().get('model_name', 'gemini-1.5-flash')
     
     for attempt in range(max_retries):
         try:
@@ -148,8 +318,7 @@ def get_gemini_model_with_retry(max_retries=None):
             if not api_key:
                 continue
             
-            genai.configure(api_key=api_key)
-            model = genai.GenerativeModel(model_name)
+            model = get_model_for_key(api_key, model_name)
             
             # 記錄當前使用的 Key（僅顯示前8個字元）
             key_preview = api_key[:8] + '...' if len(api_key) > 8 else api_key
@@ -171,6 +340,43 @@ def get_gemini_model():
     """取得配置好的 Gemini Model（使用輪替的 API Key）- 簡化版本"""
     return get_gemini_model_with_retry(max_retries=1)
 
+def generate_with_retry(prompt, max_attempts=3, **kwargs):
+    """
+    呼叫 Gemini 產生內容：每次嘗試換一個 API Key，失敗時以指數退避（加上隨機抖動）重試
+    配額用盡的 Key 會進入冷卻，冷卻期間不會再被選到
+    kwargs 會直接傳給 generate_content（例如 generation_config、stream）
+    """
+    model_name = _get_config().get('model_name', 'gemini-1.5-flash')
+    last_error = None
+    
+    for attempt in range(max_attempts):
+        if attempt:
+            # 避免在同一瞬間把所有 Key 的配額用光
+            time.sleep(min(0.1 * 2 ** attempt, 2) + random.random() * 0.1)
+        
+        api_key = get_next_api_key()
+        if not api_key:
+            break
+        
+        # 記錄當前使用的 Key（僅顯示前8個字元）
+        key_preview = api_key[:8] + '...' if len(api_key) > 8 else api_key
+        print(f'🔑 使用 API Key: {key_preview} (嘗試 {attempt + 1}/{max_attempts})')
+        
+        try:
+            model = get_model_for_key(api_key, model_name)
+            return model.generate_content(prompt, **kwargs)
+        except RETRYABLE_GEMINI_ERRORS as e:
+            if isinstance(e, ResourceExhausted):
+                mark_key_cooldown(api_key)
+                print(f'⚠️ API Key 配額已滿，冷卻 {KEY_COOLDOWN_SECONDS} 秒後再使用')
+            else:
+                print(f'⚠️ Gemini 暫時無法回應: {str(e)[:100]}')
+            last_error = e
+    
+    if last_error is None:
+        last_error = ResourceExhausted('所有 API Keys 都在冷卻中，請稍後再試')
+    raise last_error
+
 # 載入配置
 gemini_model = None
 try:
@@ -196,75 +402,20 @@ backend_status = {
 
 # 安全執行配置
 EXECUTION_TIMEOUT = 5  # 5秒執行超時
-MAX_OUTPUT_LENGTH = 10000  # 最大輸出長度
-
-# 允許的內建函數白名單
-SAFE_BUILTINS = {
-    'print': print,
-    'len': len,
-    'str': str,
-    'int': int,
-    'float': float,
-    'bool': bool,
-    'list': list,
-    'dict': dict,
-    'tuple': tuple,
-    'set': set,
-    'range': range,
-    'enumerate': enumerate,
-    'zip': zip,
-    'sum': sum,
-    'min': min,
-    'max': max,
-    'abs': abs,
-    'round': round,
-    'sorted': sorted,
-    'reversed': reversed,
-    'type': type,
-    'isinstance': isinstance,
-    'hasattr': hasattr,
-    'getattr': getattr,
-    'chr': chr,
-    'ord': ord,
-    'bin': bin,
-    'hex': hex,
-    'oct': oct,
-    'pow': pow,
-    'divmod': divmod,
-    'all': all,
-    'any': any,
-    'filter': filter,
-    'map': map,
-    # 數學函數
-    'complex': complex,
-    # 添加安全的 __import__ 實現
-    '__import__': __import__,  # 我們會用自定義的安全版本替換
-    # 不包含危險函數: open, exec, eval, compile, globals, locals, vars, dir
-}
-
-# 允許的模組白名單
-ALLOWED_MODULES = {
-    'math',
-    'random',
-    'datetime',
-    'decimal',
-    'fractions',
-    'statistics',
-    'string',
-    'json',
-    're'  # 正則表達式，但會限制某些功能
-}
+SANDBOX_MEMORY_LIMIT = 256 * 1024 * 1024  # 子行程記憶體上限 (bytes)
+SANDBOX_MAX_OPEN_FILES = 16  # 子行程可開啟的檔案描述符上限
+RUNNER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'runner.py')
 
 # 危險的 AST 節點類型
-DANGEROUS_NODES = {
+DANGEROUS_NODES = frozenset({
     # ast.Import,      # 移除，改為檢查模組名稱
     # ast.ImportFrom,  # 移除，改為檢查模組名稱 
     ast.Global,      # global 語句
     ast.Nonlocal,    # nonlocal 語句
-}
+})
 
 # 危險的函數名稱
-DANGEROUS_FUNCTIONS = {
+DANGEROUS_FUNCTIONS = frozenset({
     'open', 'file', 'raw_input',  # input 已移除，改用安全包裝
     'exec', 'eval', 'compile',
     'globals', 'locals', 'vars', 'dir',
@@ -272,80 +423,149 @@ DANGEROUS_FUNCTIONS = {
     'exit', 'quit', 'help', 'license', 'credits',
     'reload', 'execfile'
     # 移除 '__import__' 和 'getattr', 'hasattr' 因為我們需要它們
-}
+})
 
-def safe_import(name, globals=None, locals=None, fromlist=(), level=0):
+# 禁止存取的屬性
+DANGEROUS_ATTRS = frozenset({'__globals__', '__locals__', '__builtins__', '__file__', '__name__'})
+
+# 程式碼快取：{digest: (code_obj, is_safe, error_message, cached_at)}
+# 由 /api/validate 與 /api/execute 共用，學生重複執行同一段程式碼時不必再次檢查與編譯
+CODE_CACHE_SIZE = 1024
+CODE_CACHE_FAILURE_TTL = 300  # 失敗的結果最多保留 5 分鐘
+code_cache = OrderedDict()
+code_cache_lock = threading.Lock()
+
+def code_digest(code):
     """
-    安全的模組導入函數，只允許導入白名單中的模組
+    計算程式碼的 blake2b 雜湊，作為程式碼快取的鍵
     """
-    if name not in ALLOWED_MODULES:
-        raise ImportError(f"不允許導入模組: {name}")
-    
-    # 使用原始的 __import__ 導入允許的模組
-    return __builtins__.__import__(name, globals, locals, fromlist, level)
+    return hashlib.blake2b(code.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
 
-def create_safe_input(input_queue):
+def _get_code_entry(code, digest=None):
     """
-    創建安全的 input 函數，從預先提供的輸入佇列中讀取
+    取得程式碼的快取項目，未命中時解析、檢查並編譯後存入（LRU）
+    返回 (code_obj, is_safe, error_message, cached_at)
     """
-    input_index = [0]  # 使用列表來保持可變性
+    if digest is None:
+        digest = code_digest(code)
+    
+    with code_cache_lock:
+        entry = code_cache.get(digest)
+        if entry is not None:
+            if entry[0] is None and time.monotonic() - entry[3] > CODE_CACHE_FAILURE_TTL:
+                del code_cache[digest]
+            else:
+                code_cache.move_to_end(digest)
+                return entry
+    
+    entry = _build_code_entry(code)
     
-    def safe_input(prompt=''):
-        if input_index[0] >= len(input_queue):
-            raise EOFError('沒有更多輸入資料')
-        value = input_queue[input_index[0]]
-        input_index[0] += 1
-        # 如果有提示訊息，也輸出它（模擬真實 input 行為）
-        if prompt:
-            print(prompt, end='')
-        print(value)  # 輸出輸入的值（模擬使用者輸入）
-        return value
+    with code_cache_lock:
+        code_cache[digest] = entry
+        code_cache.move_to_end(digest)
+        # 超過上限時移除最久未使用的項目
+        if len(code_cache) > CODE_CACHE_SIZE:
+            code_cache.popitem(last=False)
     
-    return safe_input
+    return entry
 
-def validate_code_safety(code):
+def validate_code_safety(code, digest=None):
     """
-    檢查程式碼是否安全
+    檢查程式碼是否安全（以程式碼的 blake2b 雜湊快取結果）
     返回 (is_safe, error_message)
     """
+    _, is_safe, error, _ = _get_code_entry(code, digest)
+    if not is_safe:
+        return False, error
+    return True, None
+
+def compile_user_code(code, digest=None):
+    """
+    取得程式碼編譯後的 code object（以雜湊快取）
+    返回 (code_obj, error_message)，未通過安全檢查或無法編譯時 code_obj 為 None
+    """
+    code_obj, _, error, _ = _get_code_entry(code, digest)
+    return code_obj, error
+
+def _check_import(node):
+    # 檢查導入語句
+    for alias in node.names:
+        if alias.name not in ALLOWED_MODULES:
+            return f"不允許導入模組: {alias.name}"
+
+def _check_import_from(node):
+    if node.module and node.module not in ALLOWED_MODULES:
+        return f"不允許導入模組: {node.module}"
+
+def _check_call(node):
+    # 檢查函數調用
+    if isinstance(node.func, ast.Name) and node.func.id in DANGEROUS_FUNCTIONS:
+        return f"不允許使用函數: {node.func.id}"
+
+def _check_attribute(node):
+    # 阻止存取某些危險屬性
+    if node.attr in DANGEROUS_ATTRS:
+        return f"不允許存取屬性: {node.attr}"
+
+# 依節點類型分派的檢查函數
+_NODE_CHECKS = {
+    ast.Import: _check_import,
+    ast.ImportFrom: _check_import_from,
+    ast.Call: _check_call,
+    ast.Attribute: _check_attribute,
+}
+
+def _find_safety_violation(tree):
+    """
+    以佇列迭代走訪 AST（廣度優先，與 ast.walk 的順序相同），遇到第一個違規就回傳錯誤訊息
+    有多個違規時回報的錯誤與 ast.walk 逐一檢查的結果一致；沒有違規時回傳 None
+    """
+    todo = deque([tree])
+    while todo:
+        node = todo.popleft()
+        node_type = type(node)
+        
+        # 檢查危險的節點類型
+        if node_type in DANGEROUS_NODES:
+            return f"不允許使用: {node_type.__name__}"
+        
+        check = _NODE_CHECKS.get(node_type)
+        if check is not None:
+            error = check(node)
+            if error:
+                return error
+        
+        todo.extend(ast.iter_child_nodes(node))
+    
+    return None
+
+def _build_code_entry(code):
+    """
+    實際解析、檢查並編譯程式碼（不經過快取）
+    通過檢查的 AST 直接交給 compile，不必重新解析；保留 assert（optimize=0），學生常用 assert 自行驗證結果
+    返回 (code_obj, is_safe, error_message, cached_at)
+    """
+    now = time.monotonic()
     try:
         tree = ast.parse(code)
-    except SyntaxError as e:
-        return False, f"語法錯誤: {str(e)}"
+    except (SyntaxError, ValueError) as e:
+        return None, False, f"語法錯誤: {str(e)}", now
     
-    for node in ast.walk(tree):
-        # 檢查導入語句
-        if isinstance(node, ast.Import):
-            for alias in node.names:
-                if alias.name not in ALLOWED_MODULES:
-                    return False, f"不允許導入模組: {alias.name}"
-        elif isinstance(node, ast.ImportFrom):
-            if node.module and node.module not in ALLOWED_MODULES:
-                return False, f"不允許導入模組: {node.module}"
-        
-        # 檢查其他危險的節點類型
-        elif type(node) in DANGEROUS_NODES:
-            return False, f"不允許使用: {type(node).__name__}"
-        
-        # 檢查函數調用
-        elif isinstance(node, ast.Call):
-            if isinstance(node.func, ast.Name):
-                func_name = node.func.id
-                if func_name in DANGEROUS_FUNCTIONS:
-                    return False, f"不允許使用函數: {func_name}"
-        
-        # 檢查屬性存取
-        elif isinstance(node, ast.Attribute):
-            # 阻止存取某些危險屬性
-            dangerous_attrs = {'__globals__', '__locals__', '__builtins__', '__file__', '__name__'}
-            if node.attr in dangerous_attrs:
-                return False, f"不允許存取屬性: {node.attr}"
+    error = _find_safety_violation(tree)
+    if error:
+        return None, False, error, now
     
-    return True, None
+    try:
+        code_obj = compile(tree, '<user>', 'exec', optimize=0)
+    except (SyntaxError, ValueError) as e:
+        # 語法樹合法但無法編譯（例如函數外的 return），仍視為安全，執行時回報錯誤
+        return None, True, str(e), now
+    
+    return code_obj, True, None, now
 
-def execute_with_timeout(code, timeout=EXECUTION_TIMEOUT, inputs=None):
+def execute_with_timeout(code, timeout=EXECUTION_TIMEOUT, inputs=None, digest=None):
     """
-    在限定時間內執行程式碼
+    在獨立子行程中限時執行程式碼，超時直接終止子行程
     inputs: 可選的輸入列表，用於 input() 函數
     """
     result = {'output': '', 'error': None, 'timeout': False}
@@ -354,52 +574,49 @@ def execute_with_timeout(code, timeout=EXECUTION_TIMEOUT, inputs=None):
     if inputs is None:
         inputs = []
     
-    def target():
-        try:
-            # 創建安全的執行環境
-            safe_globals = {
-                '__builtins__': SAFE_BUILTINS.copy(),
-                '__name__': '__main__',
-            }
-            # 使用我們的安全導入函數
-            safe_globals['__builtins__']['__import__'] = safe_import
-            # 添加安全的 input 函數
-            safe_globals['__builtins__']['input'] = create_safe_input(inputs)
-            
-            safe_locals = {}
-            
-            # 重新導向輸出
-            output_buffer = io.StringIO()
-            error_buffer = io.StringIO()
-            
-            with contextlib.redirect_stdout(output_buffer), contextlib.redirect_stderr(error_buffer):
-                exec(code, safe_globals, safe_locals)
-            
-            output = output_buffer.getvalue()
-            errors = error_buffer.getvalue()
-            
-            # 限制輸出長度
-            if len(output) > MAX_OUTPUT_LENGTH:
-                output = output[:MAX_OUTPUT_LENGTH] + '\n...(輸出被截斷)'
-            
-            if errors:
-                output = output + '\n' + errors if output else errors
-            
-            result['output'] = output if output else '(程式執行成功，無輸出)'
-            
-        except Exception as e:
-            result['error'] = str(e)
+    code_obj, error = compile_user_code(code, digest)
+    if code_obj is None:
+        result['error'] = error
+        return result
+    
+    # 以 marshal 傳送已編譯的 code object，子行程使用同一個直譯器，不必重新解析
+    payload = marshal.dumps({
+        'code': code_obj,
+        'inputs': inputs,
+        'limits': {
+            'RLIMIT_CPU': timeout + 1,
+            'RLIMIT_AS': SANDBOX_MEMORY_LIMIT,
+            'RLIMIT_NOFILE': SANDBOX_MAX_OPEN_FILES,
+        },
+    })
     
-    thread = threading.Thread(target=target)
-    thread.daemon = True
-    thread.start()
-    thread.join(timeout)
+    # -I 隔離模式（忽略 PYTHON* 環境變數與使用者 site-packages），-S 跳過 site 加快啟動
+    process = subprocess.Popen(
+        [sys.executable, '-I', '-S', RUNNER_PATH],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
     
-    if thread.is_alive():
+    try:
+        stdout, stderr = process.communicate(payload, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
         result['timeout'] = True
         result['error'] = f'程式執行超時 ({timeout} 秒)，可能存在無限迴圈'
-        # 注意：Python 的 threading 無法強制終止線程，這是一個限制
+        return result
     
+    try:
+        child_result = json.loads(stdout)
+    except ValueError:
+        # 子行程被資源上限終止（記憶體不足、CPU 超時）或異常結束
+        print(f"⚠️ 沙箱子行程異常結束 (exit code {process.returncode}): {stderr.decode('utf-8', 'replace')[-500:]}")
+        result['error'] = '程式執行異常結束，可能超過記憶體或 CPU 使用限制'
+        return result
+    
+    result['output'] = child_result['output']
+    result['error'] = child_result['error']
     return result
 
 @app.route('/api/execute', methods=['POST'])
@@ -447,8 +664,9 @@ def execute_code():
                     'error': '每個輸入必須是字串且不超過 1000 字元'
                 })
         
-        # 安全性檢查
-        is_safe, safety_error = validate_code_safety(code)
+        # 安全性檢查（雜湊只計算一次，與編譯快取共用）
+        digest = code_digest(code)
+        is_safe, safety_error = validate_code_safety(code, digest)
         if not is_safe:
             return jsonify({
                 'success': False,
@@ -456,7 +674,7 @@ def execute_code():
             })
         
         # 在安全環境中執行程式碼（傳入輸入資料）
-        execution_result = execute_with_timeout(code, inputs=inputs)
+        execution_result = execute_with_timeout(code, inputs=inputs, digest=digest)
         
         if execution_result['timeout']:
             return jsonify({
@@ -495,7 +713,7 @@ def validate_code():
                 'error': '沒有收到程式碼'
             })
         
-        # 安全性檢查
+        # 安全性檢查（結果與 /api/execute 共用快取）
         is_safe, safety_error = validate_code_safety(code)
         
         return jsonify({
@@ -510,83 +728,8 @@ def validate_code():
             'error': f'伺服器錯誤: {str(e)}'
         })
 
-@app.route('/api/ai/analyze', methods=['POST'])
-def ai_analyze_code():
-    """
-    使用 Gemini AI 分析程式碼品質並給出建議（結構化輸出）
-    """
-    try:
-        if not api_keys_list:
-            return jsonify({
-                'success': False,
-                'error': 'Gemini API 未初始化，請檢查 api_keys.json 或 config.json'
-            })
-        
-        # 取得輪替的 model（自動嘗試多個 keys）
-        model = get_gemini_model_with_retry(max_retries=min(5, len(api_keys_list)))
-        if not model:
-            return jsonify({
-                'success': False,
-                'error': f'所有 API Keys 都超過配額或失敗，請稍後再試（共嘗試了 {min(5, len(api_keys_list))} 個 Keys）'
-            })
-        
-        data = request.get_json()
-        code = data.get('code', '')
-        output = data.get('output', '')
-        expected_output = data.get('expected_output', '')
-        question = data.get('question', '')
-        custom_prompt = data.get('custom_prompt', None)  # 🧪 自訂提示詞（測試用）
-        
-        if not code:
-            return jsonify({
-                'success': False,
-                'error': '沒有收到程式碼'
-            })
-        
-        # 定義結構化輸出 schema
-        response_schema = {
-            "type": "object",
-            "properties": {
-                "feedback": {
-                    "type": "string",
-                    "description": "針對程式的整體評語和建議"
-                },
-                "overall_score": {
-                    "type": "integer",
-                    "description": "程式整體評分 (0-100)"
-                },
-                "time_complexity_score": {
-                    "type": "integer",
-                    "description": "時間複雜度評分 (0-10)，評估演算法執行效率"
-                },
-                "space_complexity_score": {
-                    "type": "integer",
-                    "description": "空間複雜度評分 (0-10)，評估記憶體使用效率"
-                },
-                "readability_score": {
-                    "type": "integer",
-                    "description": "程式易讀性評分 (0-10)，評估變數命名、註解、程式碼風格"
-                },
-                "stability_score": {
-                    "type": "integer",
-                    "description": "程式穩定性評分 (0-10)，評估錯誤處理和邊界條件"
-                }
-            },
-            "required": ["feedback", "overall_score", "time_complexity_score", "space_complexity_score", "readability_score", "stability_score"]
-        }
-        
-        # 構建 AI 分析提示
-        # 🧪 如果有自訂提示詞（測試模式），優先使用自訂提示詞
-        if custom_prompt:
-            prompt_template = custom_prompt
-            print('🧪 使用前端傳來的自訂提示詞（測試模式）')
-        else:
-            # 從 prompts.json 載入
-            prompt_template = prompts_config.get('analyze_prompt', {}).get('template', '')
-        
-        if not prompt_template:
-            # 如果載入失敗，使用預設提示詞
-            prompt_template = """你是一位專業的 Python 程式教學專家。請全面分析以下學生的程式碼：
+# 預設提示詞（prompts.json 沒有對應設定時使用）
+DEFAULT_ANALYZE_PROMPT = """你是一位專業的 Python 程式教學專家。請全面分析以下學生的程式碼：
 
 【題目要求】
 {question}
@@ -640,6 +783,329 @@ def ai_analyze_code():
 - 請確保評分在指定範圍內
 
 請用繁體中文回覆，並確保評分合理反映程式品質。"""
+
+DEFAULT_CHECK_PROMPT = """快速檢查這段 Python 程式：
+
+程式碼：
+{code}
+
+實際輸出：
+{output}
+
+預期輸出：
+{expected_output}
+
+請回答：
+1. 輸出是否完全一致？（是/否）
+2. 給予分數 (0-100)
+3. 如果不一致，指出差異在哪裡
+
+用 JSON 格式回覆：
+{{
+    "match": true/false,
+    "score": 85,
+    "differences": ["差異1", "差異2"]
+}}
+"""
+
+DEFAULT_SUGGEST_PROMPT = """你是一位專業且親切的程式設計老師，使用「引導式學習」教導學生寫程式。
+
+【教學規則】
+1. 不直接給完整答案，先用問題與提示一步步引導學生自己思考
+2. 每次回覆時，都要先肯定學生的一小部分（例如：哪段想法是對的、哪裡寫得不錯）
+3. 根據學生的程式碼，說明目前狀況是否正確，若有錯誤，用簡單的話說明問題點，並給 1～3 個提示讓學生自己修正
+4. 在回覆結尾，一定要主動提出 3～5 個相關且能深化理解的「後續問題」，格式為 Q1、Q2、Q3...
+5. 回覆語氣友善、清楚，用繁體中文（台灣用語），讓學生感到被支持、陪伴，而不是被糾正
+
+【當前教學情境】
+學生得分：{score}
+
+程式碼內容：
+```python
+{code}
+```
+
+執行結果：
+{output}
+
+學習統計：
+- 執行次數：{run_count}
+- 錯誤次數：{error_count}
+- 成功率：{success_rate}%
+- 修改次數：{modifications}
+在回覆結尾，一定要主動提出 3～5 個相關且能深化理解的「後續問題」，格式為 Q1、Q2、Q3...
+"""
+
+def load_prompt_template(name, default, fields):
+    """
+    啟動時從 prompts.json 取出提示詞模板（只需執行一次）
+    同時檢查模板欄位，避免等到請求時才因未知欄位而 format 失敗
+    fields: 該端點會提供給模板的欄位名稱
+    """
+    template = prompts_config.get(name, {}).get('template', '')
+    if not template:
+        return default
+    
+    try:
+        unknown = {field for _, field, _, _ in string.Formatter().parse(template) if field is not None} - fields
+    except ValueError as e:
+        print(f'⚠️  警告：提示詞 {name} 格式錯誤，改用預設提示詞: {str(e)}')
+        return default
+    
+    if unknown:
+        print(f'⚠️  警告：提示詞 {name} 包含未知欄位 {sorted(unknown)}，改用預設提示詞')
+        return default
+    
+    return template
+
+ANALYZE_PROMPT_TEMPLATE = load_prompt_template(
+    'analyze_prompt', DEFAULT_ANALYZE_PROMPT,
+    {'question', 'code', 'output', 'expected_output'}
+)
+CHECK_PROMPT_TEMPLATE = load_prompt_template(
+    'check_prompt', DEFAULT_CHECK_PROMPT,
+    {'code', 'output', 'expected_output'}
+)
+SUGGEST_PROMPT_TEMPLATE = load_prompt_template(
+    'suggest_prompt', DEFAULT_SUGGEST_PROMPT,
+    {'score', 'code', 'output', 'run_count', 'error_count', 'success_rate', 'modifications'}
+)
+
+# chat 系統提示詞預設值（prompts.json 未提供 base_rules 時使用）
+DEFAULT_CHAT_BASE_RULES = """你是一位專業且親切的程式設計老師，使用「引導式學習」教導學生寫程式。
+
+【教學規則】
+1. 不直接給完整答案，先用問題與提示一步步引導學生自己思考
+2. 每次回覆時，都要先肯定學生的一小部分（例如：哪段想法是對的、哪裡寫得不錯）
+3. 根據學生的程式碼，說明目前狀況是否正確，若有錯誤，用簡單的話說明問題點，並給 1～3 個提示讓學生自己修正
+4. 在回覆結尾，一定要主動提出 3～5 個相關且能深化理解的「後續問題」，格式為 Q1、Q2、Q3...
+5. 回覆語氣友善、清楚，用繁體中文（台灣用語），讓學生感到被支持、陪伴，而不是被糾正
+6. 除非學生明確要求「請直接給我完整答案」，否則不要一次貼出完整解答程式碼，只能貼關鍵片段或偽碼做提示
+
+"""
+
+_DEFAULT_CONTEXT_SECTIONS = {
+    "question": "【當前題目】\n{question_info}\n\n",
+    "current_code": "【學生當前程式碼】\n```python\n{current_code}\n```\n\n",
+    "current_code_empty": "【學生當前程式碼】\n(尚未撰寫程式碼)\n\n",
+    "current_output": "【當前執行結果】\n{current_output}\n\n",
+    "current_output_empty": "【當前執行結果】\n(尚未執行)\n\n",
+    "last_score": "【上次 AI 評分】\n總分：{overall}/100\n- 時間複雜度：{time_complexity}/10\n- 空間複雜度：{space_complexity}/10\n- 可讀性：{readability}/10\n- 穩定性：{stability}/10\n\n",
+    "last_score_empty": "【上次 AI 評分】\n尚未評分\n\n",
+    "last_score_code": "【上次評分時的程式碼】\n```python\n{last_score_code}\n```\n\n",
+    "last_score_output": "【上次評分時的執行結果】\n{last_score_output}\n\n",
+    "stats": "【學習統計】\n- 執行次數：{run_count}\n- 錯誤次數：{error_count}\n- 成功率：{success_rate}%\n- 修改次數：{modifications}\n\n",
+    "user_message": "【學生問題】\n{user_message}\n\n",
+    "final_instruction": "請依照「教學規則」回答，用友善且引導式的方式幫助學生思考和學習。記得在回覆結尾提出 3～5 個後續問題（Q1、Q2、Q3...）。"
+}
+
+# chat 回覆一律附加的 Markdown 格式指示
+_MARKDOWN_FOOTER = (
+    "\n\n**重要格式要求**：請使用 Markdown 格式回覆，包括：\n"
+    "- 使用 `##` 或 `###` 建立標題和子標題\n"
+    "- 使用 `**粗體**` 強調重點\n"
+    "- 使用 `- ` 或 `1. ` 建立清單\n"
+    "- 使用 `` `code` `` 標記行內程式碼\n"
+    "- 使用 ```python 程式碼區塊標記多行程式碼\n"
+    "- 使用 `>` 建立引用區塊\n"
+    "- 適當使用表格來呈現評分或比較資訊\n"
+    "讓回覆更易讀、更有結構，類似 ChatGPT 的風格。\n"
+)
+
+def load_chat_prompt():
+    """
+    合併 prompts.json 的 chat 設定與預設值，返回 (base_rules, context_sections)
+    未提供 base_rules 時整組使用預設值；缺少的段落以預設段落補齊
+    """
+    chat_prompt_config = prompts_config.get('chat_system_prompt', {})
+    base_rules = chat_prompt_config.get('base_rules', '')
+    if not base_rules:
+        return DEFAULT_CHAT_BASE_RULES, dict(_DEFAULT_CONTEXT_SECTIONS)
+    
+    context_sections = dict(_DEFAULT_CONTEXT_SECTIONS)
+    context_sections.update(chat_prompt_config.get('context_sections', {}))
+    return base_rules, context_sections
+
+# chat 各段落可使用的欄位；空集合表示該段落原樣輸出（不做變數替換）
+_CHAT_SECTION_FIELDS = {
+    'question': {'question_info'},
+    'current_code': {'current_code'},
+    'current_code_empty': set(),
+    'current_output': {'current_output'},
+    'current_output_empty': set(),
+    'last_score': {'overall', 'time_complexity', 'space_complexity', 'readability', 'stability'},
+    'last_score_empty': set(),
+    'last_score_code': {'last_score_code'},
+    'last_score_output': {'last_score_output'},
+    'stats': {'run_count', 'error_count', 'success_rate', 'modifications'},
+    'user_message': {'user_message'},
+    'final_instruction': set(),
+}
+
+# 提示詞是純文字，不做 HTML 跳脫，並保留結尾換行
+_chat_jinja_env = jinja2.Environment(autoescape=False, keep_trailing_newline=True)
+
+def _jinja_literal(text, literals):
+    """
+    將純文字放進 literals，模板中以 {{ _lit[n] }} 輸出
+    文字不進入模板原始碼，因此其中的 Jinja2 語法與 CRLF 換行都會原樣保留
+    """
+    if not text:
+        return ''
+    literals.append(text)
+    return '{{ _lit[' + str(len(literals) - 1) + '] }}'
+
+def _section_to_jinja(name, template, literals):
+    """
+    將 str.format 格式的段落轉成 Jinja2 語法（文字部分放進 literals）
+    欄位格式錯誤或包含未知欄位時改用預設段落
+    """
+    fields = _CHAT_SECTION_FIELDS[name]
+    if not fields:
+        return _jinja_literal(template, literals)
+    
+    try:
+        parsed = list(string.Formatter().parse(template))
+    except ValueError as e:
+        print(f'⚠️  警告：chat 段落 {name} 格式錯誤，改用預設段落: {str(e)}')
+        return _section_to_jinja(name, _DEFAULT_CONTEXT_SECTIONS[name], literals)
+    
+    unknown = {field for _, field, _, _ in parsed if field is not None} - fields
+    if unknown:
+        print(f'⚠️  警告：chat 段落 {name} 包含未知欄位 {sorted(unknown)}，改用預設段落')
+        return _section_to_jinja(name, _DEFAULT_CONTEXT_SECTIONS[name], literals)
+    
+    # 只支援單純的 {欄位}，格式規格與轉換（如 {x:>5}、{x!r}）無法對應到模板
+    if any(spec or conversion for _, field, spec, conversion in parsed if field is not None):
+        print(f'⚠️  警告：chat 段落 {name} 使用了不支援的格式規格，改用預設段落')
+        return _section_to_jinja(name, _DEFAULT_CONTEXT_SECTIONS[name], literals)
+    
+    pieces = []
+    for literal, field, _, _ in parsed:
+        pieces.append(_jinja_literal(literal, literals))
+        if field is not None:
+            pieces.append('{{ ' + field + ' }}')
+    return ''.join(pieces)
+
+def build_chat_template(base_rules, sections):
+    """
+    將 chat 系統提示詞組成單一 Jinja2 模板（啟動時編譯一次）
+    各段落的顯示條件與舊版逐段串接的邏輯相同
+    """
+    literals = []
+    base = _jinja_literal(base_rules, literals)
+    s = {name: _section_to_jinja(name, text, literals) for name, text in sections.items()}
+    source = (
+        base
+        # 1. 題目要求
+        + '{% if question_info %}' + s['question'] + '{% endif %}'
+        # 2. 當前程式碼內容
+        + '{% if current_code %}' + s['current_code'] + '{% else %}' + s['current_code_empty'] + '{% endif %}'
+        # 3. 當前執行結果
+        + '{% if current_output %}' + s['current_output'] + '{% else %}' + s['current_output_empty'] + '{% endif %}'
+        # 4. 上一次 AI 評分結果
+        + '{% if last_score %}' + s['last_score'] + '{% else %}' + s['last_score_empty'] + '{% endif %}'
+        # 5. 上一次評分時的程式碼
+        + '{% if last_score_code %}' + s['last_score_code'] + '{% endif %}'
+        # 6. 上一次評分時的執行結果
+        + '{% if last_score_output %}' + s['last_score_output'] + '{% endif %}'
+        # 7. 學習統計
+        + '{% if stats %}' + s['stats'] + '{% endif %}'
+        # 最後加上學生問題與結尾指示
+        + s['user_message']
+        + s['final_instruction']
+    )
+    return _chat_jinja_env.from_string(source, globals={'_lit': tuple(literals)})
+
+CHAT_TEMPLATE = build_chat_template(*load_chat_prompt())
+
+# Server-Sent Events 結束訊號
+_DONE_FRAME = b"data: [DONE]\n\n"
+
+def sse_frame(payload):
+    """
+    將資料編碼成一個 SSE 事件（bytes），有 orjson 時直接輸出 UTF-8 bytes
+    """
+    if orjson is not None:
+        return b"data: " + orjson.dumps(payload) + b"\n\n"
+    return b"data: " + json.dumps(payload).encode('utf-8') + b"\n\n"
+
+# AI 回應中包住 JSON 的 Markdown 程式碼區塊（```json ... ``` 或 ``` ... ```）
+# 結尾的 ``` 可省略：回應被截斷（例如達到輸出長度上限）時取到文字結尾
+_FENCE_RE = re.compile(r'```(?:json)?\s*(.*?)(?:```|\Z)', re.S)
+
+def strip_code_fence(text):
+    """
+    取出第一個 Markdown 程式碼區塊的內容，沒有區塊時回傳原文
+    """
+    match = _FENCE_RE.search(text)
+    return match.group(1).strip() if match else text
+
+@app.route('/api/ai/analyze', methods=['POST'])
+def ai_analyze_code():
+    """
+    使用 Gemini AI 分析程式碼品質並給出建議（結構化輸出）
+    """
+    try:
+        if not api_keys_list:
+            return jsonify({
+                'success': False,
+                'error': 'Gemini API 未初始化，請檢查 api_keys.json 或 config.json'
+            })
+        
+        data = request.get_json()
+        code = data.get('code', '')
+        output = data.get('output', '')
+        expected_output = data.get('expected_output', '')
+        question = data.get('question', '')
+        custom_prompt = data.get('custom_prompt', None)  # 🧪 自訂提示詞（測試用）
+        
+        if not code:
+            return jsonify({
+                'success': False,
+                'error': '沒有收到程式碼'
+            })
+        
+        # 定義結構化輸出 schema
+        response_schema = {
+            "type": "object",
+            "properties": {
+                "feedback": {
+                    "type": "string",
+                    "description": "針對程式的整體評語和建議"
+                },
+                "overall_score": {
+                    "type": "integer",
+                    "description": "程式整體評分 (0-100)"
+                },
+                "time_complexity_score": {
+                    "type": "integer",
+                    "description": "時間複雜度評分 (0-10)，評估演算法執行效率"
+                },
+                "space_complexity_score": {
+                    "type": "integer",
+                    "description": "空間複雜度評分 (0-10)，評估記憶體使用效率"
+                },
+                "readability_score": {
+                    "type": "integer",
+                    "description": "程式易讀性評分 (0-10)，評估變數命名、註解、程式碼風格"
+                },
+                "stability_score": {
+                    "type": "integer",
+                    "description": "程式穩定性評分 (0-10)，評估錯誤處理和邊界條件"
+                }
+            },
+            "required": ["feedback", "overall_score", "time_complexity_score", "space_complexity_score", "readability_score", "stability_score"]
+        }
+        
+        # 構建 AI 分析提示
+        # 🧪 如果有自訂提示詞（測試模式），優先使用自訂提示詞
+        if custom_prompt:
+            prompt_template = custom_prompt
+            print('🧪 使用前端傳來的自訂提示詞（測試模式）')
+        else:
+            # 使用啟動時載入的提示詞（prompts.json 或預設值）
+            prompt_template = ANALYZE_PROMPT_TEMPLATE
         
         prompt = prompt_template.format(
             question=question if question else '請撰寫一個 Python 程式，輸出指定的文字內容。',
@@ -654,60 +1120,38 @@ def ai_analyze_code():
             response_schema=response_schema
         )
         
-        try:
-            response = model.generate_content(
-                prompt,
-                generation_config=generation_config
-            )
-            
-            # 解析 JSON 回應
-            analysis = json.loads(response.text)
-            
-            return jsonify({
-                'success': True,
-                'analysis': analysis
-            })
+        # 配額已滿或暫時性錯誤時自動換 Key 重試
+        response = generate_with_retry(
+            prompt,
+            max_attempts=5,
+            generation_config=generation_config
+        )
         
-        except Exception as api_error:
-            # 檢查是否為配額錯誤
-            error_msg = str(api_error)
-            if '429' in error_msg or 'quota' in error_msg.lower() or 'rate limit' in error_msg.lower():
-                print(f"⚠️ API Key 配額已滿，嘗試下一個 Key...")
-                # 再試一次不同的 Key
-                model = get_gemini_model_with_retry(max_retries=min(3, len(api_keys_list)))
-                if model:
-                    try:
-                        response = model.generate_content(
-                            prompt,
-                            generation_config=generation_config
-                        )
-                        analysis = json.loads(response.text)
-                        return jsonify({
-                            'success': True,
-                            'analysis': analysis
-                        })
-                    except Exception as retry_error:
-                        print(f"❌ 重試後仍失敗: {str(retry_error)}")
-            
-            raise api_error
+        # 解析 JSON 回應
+        analysis = app.json.loads(response.text)
+        
+        return jsonify({
+            'success': True,
+            'analysis': analysis
+        })
         
+    except ResourceExhausted as e:
+        # 配額錯誤很常見，提供友善訊息，不必印出完整 traceback
+        print(f"⚠️ AI 分析失敗（配額已滿）: {str(e)[:200]}")
+        return jsonify({
+            'success': False,
+            'error': f'所有 API Keys 都已達到配額限制，請稍後再試（約1分鐘後）'
+        })
+    
     except Exception as e:
         import traceback
-        print(f"❌ AI 分析錯誤: {str(e)}")
-        print(traceback.format_exc())
-        
-        # 提供更友善的錯誤訊息
         error_msg = str(e)
-        if '429' in error_msg or 'quota' in error_msg.lower():
-            return jsonify({
-                'success': False,
-                'error': f'所有 API Keys 都已達到配額限制，請稍後再試（約1分鐘後）'
-            })
-        else:
-            return jsonify({
-                'success': False,
-                'error': f'AI 分析失敗: {error_msg[:200]}'
-            })
+        print(f"❌ AI 分析錯誤: {error_msg}")
+        print(traceback.format_exc())
+        return jsonify({
+            'success': False,
+            'error': f'AI 分析失敗: {error_msg[:200]}'
+        })
 
 @app.route('/api/ai/check', methods=['POST'])
 def ai_check_code():
@@ -721,46 +1165,13 @@ def ai_check_code():
                 'error': 'Gemini API 未初始化'
             })
         
-        # 取得輪替的 model（自動嘗試多個 keys）
-        model = get_gemini_model_with_retry(max_retries=min(3, len(api_keys_list)))
-        if not model:
-            return jsonify({
-                'success': False,
-                'error': '所有 API Keys 都超過配額，請稍後再試'
-            })
-        
         data = request.get_json()
         code = data.get('code', '')
         output = data.get('output', '')
         expected_output = data.get('expected_output', '')
         
-        # 從 prompts.json 載入提示詞
-        prompt_template = prompts_config.get('check_prompt', {}).get('template', '')
-        if not prompt_template:
-            # 預設提示詞
-            prompt_template = """快速檢查這段 Python 程式：
-
-程式碼：
-{code}
-
-實際輸出：
-{output}
-
-預期輸出：
-{expected_output}
-
-請回答：
-1. 輸出是否完全一致？（是/否）
-2. 給予分數 (0-100)
-3. 如果不一致，指出差異在哪裡
-
-用 JSON 格式回覆：
-{{
-    "match": true/false,
-    "score": 85,
-    "differences": ["差異1", "差異2"]
-}}
-"""
+        # 使用啟動時載入的提示詞（prompts.json 或預設值）
+        prompt_template = CHECK_PROMPT_TEMPLATE
         
         prompt = prompt_template.format(
             code=code,
@@ -768,16 +1179,11 @@ def ai_check_code():
             expected_output=expected_output
         )
         
-        response = model.generate_content(prompt)
+        response = generate_with_retry(prompt)
         ai_response = response.text
         
         try:
-            if '```json' in ai_response:
-                ai_response = ai_response.split('```json')[1].split('```')[0].strip()
-            elif '```' in ai_response:
-                ai_response = ai_response.split('```')[1].split('```')[0].strip()
-            
-            result = json.loads(ai_response)
+            result = app.json.loads(strip_code_fence(ai_response))
         except:
             result = {
                 "match": False,
@@ -808,51 +1214,14 @@ def ai_suggest_improvement():
                 'error': 'Gemini API 未初始化'
             })
         
-        # 取得輪替的 model（自動嘗試多個 keys）
-        model = get_gemini_model_with_retry(max_retries=min(3, len(api_keys_list)))
-        if not model:
-            return jsonify({
-                'success': False,
-                'error': '所有 API Keys 都超過配額，請稍後再試'
-            })
-        
         data = request.get_json()
         code = data.get('code', '')
         stats = data.get('stats', {})
         output = data.get('output', '')
         score = data.get('score', None)
         
-        # 從 prompts.json 載入提示詞
-        prompt_template = prompts_config.get('suggest_prompt', {}).get('template', '')
-        if not prompt_template:
-            # 預設提示詞
-            prompt_template = """你是一位專業且親切的程式設計老師，使用「引導式學習」教導學生寫程式。
-
-【教學規則】
-1. 不直接給完整答案，先用問題與提示一步步引導學生自己思考
-2. 每次回覆時，都要先肯定學生的一小部分（例如：哪段想法是對的、哪裡寫得不錯）
-3. 根據學生的程式碼，說明目前狀況是否正確，若有錯誤，用簡單的話說明問題點，並給 1～3 個提示讓學生自己修正
-4. 在回覆結尾，一定要主動提出 3～5 個相關且能深化理解的「後續問題」，格式為 Q1、Q2、Q3...
-5. 回覆語氣友善、清楚，用繁體中文（台灣用語），讓學生感到被支持、陪伴，而不是被糾正
-
-【當前教學情境】
-學生得分：{score}
-
-程式碼內容：
-```python
-{code}
-```
-
-執行結果：
-{output}
-
-學習統計：
-- 執行次數：{run_count}
-- 錯誤次數：{error_count}
-- 成功率：{success_rate}%
-- 修改次數：{modifications}
-在回覆結尾，一定要主動提出 3～5 個相關且能深化理解的「後續問題」，格式為 Q1、Q2、Q3...
-"""
+        # 使用啟動時載入的提示詞（prompts.json 或預設值）
+        prompt_template = SUGGEST_PROMPT_TEMPLATE
         
         prompt = prompt_template.format(
             score=score if score else '尚未評分',
@@ -867,16 +1236,11 @@ def ai_suggest_improvement():
         # 🎨 自動添加 Markdown 格式指示
         prompt += "\n\n**重要格式要求**：請使用 Markdown 格式回覆，包括標題(##)、粗體(**文字**)、列表(-)、程式碼區塊(```python)等，讓回覆更易讀。\n"
         
-        response = model.generate_content(prompt)
+        response = generate_with_retry(prompt)
         ai_response = response.text
         
         try:
-            if '```json' in ai_response:
-                ai_response = ai_response.split('```json')[1].split('```')[0].strip()
-            elif '```' in ai_response:
-                ai_response = ai_response.split('```')[1].split('```')[0].strip()
-            
-            suggestions = json.loads(ai_response)
+            suggestions = app.json.loads(strip_code_fence(ai_response))
         except:
             suggestions = {
                 "affirmation": "很好！你已經開始嘗試寫程式了，這是很棒的第一步。",
@@ -913,14 +1277,6 @@ def ai_chat():
                 'error': 'Gemini API 未初始化'
             })
         
-        # 取得輪替的 model
-        model = get_gemini_model_with_retry(max_retries=min(3, len(api_keys_list)))
-        if not model:
-            return jsonify({
-                'success': False,
-                'error': '所有 API Keys 都超過配額，請稍後再試'
-            })
-        
         data = request.get_json()
         user_message = data.get('student_question', data.get('message', ''))
         custom_prompt = data.get('custom_prompt', None)  # 🧪 自訂提示詞（測試用）
@@ -947,124 +1303,59 @@ def ai_chat():
             }
             system_context = custom_prompt.format(**context_data)
         else:
-            # 從 prompts.json 載入
-            chat_prompt_config = prompts_config.get('chat_system_prompt', {})
-            base_rules = chat_prompt_config.get('base_rules', '')
-            context_sections = chat_prompt_config.get('context_sections', {})
-            
-            # 如果載入失敗，使用預設值
-            if not base_rules:
-                base_rules = """你是一位專業且親切的程式設計老師，使用「引導式學習」教導學生寫程式。
-
-【教學規則】
-1. 不直接給完整答案，先用問題與提示一步步引導學生自己思考
-2. 每次回覆時，都要先肯定學生的一小部分（例如：哪段想法是對的、哪裡寫得不錯）
-3. 根據學生的程式碼，說明目前狀況是否正確，若有錯誤，用簡單的話說明問題點，並給 1～3 個提示讓學生自己修正
-4. 在回覆結尾，一定要主動提出 3～5 個相關且能深化理解的「後續問題」，格式為 Q1、Q2、Q3...
-5. 回覆語氣友善、清楚，用繁體中文（台灣用語），讓學生感到被支持、陪伴，而不是被糾正
-6. 除非學生明確要求「請直接給我完整答案」，否則不要一次貼出完整解答程式碼，只能貼關鍵片段或偽碼做提示
-
-"""
-                context_sections = {
-                    "question": "【當前題目】\n{question_info}\n\n",
-                    "current_code": "【學生當前程式碼】\n```python\n{current_code}\n```\n\n",
-                    "current_code_empty": "【學生當前程式碼】\n(尚未撰寫程式碼)\n\n",
-                    "current_output": "【當前執行結果】\n{current_output}\n\n",
-                    "current_output_empty": "【當前執行結果】\n(尚未執行)\n\n",
-                    "last_score": "【上次 AI 評分】\n總分：{overall}/100\n- 時間複雜度：{time_complexity}/10\n- 空間複雜度：{space_complexity}/10\n- 可讀性：{readability}/10\n- 穩定性：{stability}/10\n\n",
-                    "last_score_empty": "【上次 AI 評分】\n尚未評分\n\n",
-                    "last_score_code": "【上次評分時的程式碼】\n```python\n{last_score_code}\n```\n\n",
-                    "last_score_output": "【上次評分時的執行結果】\n{last_score_output}\n\n",
-                    "stats": "【學習統計】\n- 執行次數：{run_count}\n- 錯誤次數：{error_count}\n- 成功率：{success_rate}%\n- 修改次數：{modifications}\n\n",
-                    "user_message": "【學生問題】\n{user_message}\n\n",
-                    "final_instruction": "請依照「教學規則」回答，用友善且引導式的方式幫助學生思考和學習。記得在回覆結尾提出 3～5 個後續問題（Q1、Q2、Q3...）。"
-                }
-            
-            system_context = base_rules
-            
-            # 1. 題目要求
+            # 使用啟動時編譯的 chat 模板（prompts.json 或預設值）
+            question_text = ''
             if question_info:
                 if isinstance(question_info, dict):
                     # 舊格式（字典）- 合併標題和描述
                     question_text = f"標題：{question_info.get('title', '')}\n要求：{question_info.get('description', '')}"
-                    system_context += context_sections.get('question', '【當前題目】\n{question_info}\n\n').format(question_info=question_text)
                 elif isinstance(question_info, str):
                     # 新格式（字串）
-                    system_context += context_sections.get('question', '【當前題目】\n{question_info}\n\n').format(question_info=question_info)
-            
-            # 2. 當前程式碼內容
-            if current_code:
-                system_context += context_sections.get('current_code', '【學生當前程式碼】\n```python\n{current_code}\n```\n\n').format(current_code=current_code)
-            else:
-                system_context += context_sections.get('current_code_empty', '【學生當前程式碼】\n(尚未撰寫程式碼)\n\n')
-            
-            # 3. 當前執行結果
-            if current_output:
-                system_context += context_sections.get('current_output', '【當前執行結果】\n{current_output}\n\n').format(current_output=current_output)
-            else:
-                system_context += context_sections.get('current_output_empty', '【當前執行結果】\n(尚未執行)\n\n')
+                    question_text = question_info
             
-            # 4. 上一次 AI 評分結果
+            score_fields = {}
             if last_score:
-                system_context += context_sections.get('last_score', '【上次 AI 評分】\n總分：{overall}/100\n- 時間複雜度：{time_complexity}/10\n- 空間複雜度：{space_complexity}/10\n- 可讀性：{readability}/10\n- 穩定性：{stability}/10\n\n').format(
-                    overall=last_score.get('overall', 'N/A'),
-                    time_complexity=last_score.get('time_complexity', 'N/A'),
-                    space_complexity=last_score.get('space_complexity', 'N/A'),
-                    readability=last_score.get('readability', 'N/A'),
-                    stability=last_score.get('stability', 'N/A')
-                )
-            else:
-                system_context += context_sections.get('last_score_empty', '【上次 AI 評分】\n尚未評分\n\n')
+                score_fields = {key: last_score.get(key, 'N/A') for key in
+                                ('overall', 'time_complexity', 'space_complexity', 'readability', 'stability')}
             
-            # 5. 上一次評分時的程式碼
-            if last_score_code:
-                system_context += context_sections.get('last_score_code', '【上次評分時的程式碼】\n```python\n{last_score_code}\n```\n\n').format(last_score_code=last_score_code)
-            
-            # 6. 上一次評分時的執行結果
-            if last_score_output:
-                system_context += context_sections.get('last_score_output', '【上次評分時的執行結果】\n{last_score_output}\n\n').format(last_score_output=last_score_output)
-            
-            # 7. 學習統計
+            stats_fields = {}
             if stats:
-                system_context += context_sections.get('stats', '【學習統計】\n- 執行次數：{run_count}\n- 錯誤次數：{error_count}\n- 成功率：{success_rate}%\n- 修改次數：{modifications}\n\n').format(
-                    run_count=stats.get('run_count', 0),
-                    error_count=stats.get('error_count', 0),
-                    success_rate=stats.get('success_rate', 0),
-                    modifications=stats.get('modifications', 0)
-                )
+                stats_fields = {key: stats.get(key, 0) for key in
+                                ('run_count', 'error_count', 'success_rate', 'modifications')}
             
-            # 最後加上學生問題
-            system_context += context_sections.get('user_message', '【學生問題】\n{user_message}\n\n').format(user_message=user_message)
-            system_context += context_sections.get('final_instruction', '請依照「教學規則」回答，用友善且引導式的方式幫助學生思考和學習。記得在回覆結尾提出 3～5 個後續問題（Q1、Q2、Q3...）。')
+            system_context = CHAT_TEMPLATE.render(
+                question_info=question_text,
+                current_code=current_code,
+                current_output=current_output,
+                last_score=last_score,
+                last_score_code=last_score_code,
+                last_score_output=last_score_output,
+                stats=stats,
+                user_message=user_message,
+                **score_fields,
+                **stats_fields
+            )
         
         # 🎨 自動添加 Markdown 格式指示（不修改提示詞文件）
-        system_context += "\n\n**重要格式要求**：請使用 Markdown 格式回覆，包括：\n"
-        system_context += "- 使用 `##` 或 `###` 建立標題和子標題\n"
-        system_context += "- 使用 `**粗體**` 強調重點\n"
-        system_context += "- 使用 `- ` 或 `1. ` 建立清單\n"
-        system_context += "- 使用 `` `code` `` 標記行內程式碼\n"
-        system_context += "- 使用 ```python 程式碼區塊標記多行程式碼\n"
-        system_context += "- 使用 `>` 建立引用區塊\n"
-        system_context += "- 適當使用表格來呈現評分或比較資訊\n"
-        system_context += "讓回覆更易讀、更有結構，類似 ChatGPT 的風格。\n"
-        
-        # 使用流式輸出
+        system_context += _MARKDOWN_FOOTER
+        
+        # 使用流式輸出（先建立連線，配額或連線錯誤仍以 JSON 回報給前端）
+        response = generate_with_retry(
+            system_context,
+            stream=True
+        )
+        
         def generate():
             try:
-                response = model.generate_content(
-                    system_context,
-                    stream=True
-                )
-                
                 for chunk in response:
                     if chunk.text:
                         # 發送 Server-Sent Events 格式
-                        yield f"data: {json.dumps({'text': chunk.text})}\n\n"
+                        yield sse_frame({'text': chunk.text})
                 
-                yield "data: [DONE]\n\n"
+                yield _DONE_FRAME
                 
             except Exception as e:
-                yield f"data: {json.dumps({'error': str(e)})}\n\n"
+                yield sse_frame({'error': str(e)})
         
         return Response(
             generate(),
@@ -1081,23 +1372,70 @@ def ai_chat():
             'error': f'對話失敗: {str(e)}'
         })
 
+def _set_questions_cache(questions, fetched_at=None):
+    """
+    更新題目快取並重建 id → 題目索引
+    fetched_at: 從 Google Sheets 讀取的時間，None 表示不更新（例如從本地檔案載入）
+    """
+    global questions_cache, questions_by_id, questions_last_fetch, _questions_version
+    
+    # 新的索引在鎖外建好，鎖內只做參考替換
+    by_id = {}
+    for q in questions:
+        # 重複 ID 時保留第一筆，與逐一比對的結果一致
+        by_id.setdefault(str(q.get('id')), q)
+    
+    with _questions_lock:
+        questions_by_id = by_id
+        questions_cache = questions
+        _questions_version += 1
+        if fetched_at is not None:
+            questions_last_fetch = fetched_at
+
+def refresh_questions_in_background():
+    """
+    在背景執行緒重新從 Google Sheets 讀取題目，同一時間只會有一個刷新在進行
+    """
+    global questions_refresh_in_flight
+    
+    with questions_refresh_lock:
+        if questions_refresh_in_flight:
+            return
+        questions_refresh_in_flight = True
+    
+    def worker():
+        global questions_refresh_in_flight
+        try:
+            questions = fetch_questions_from_sheet()
+            if questions:
+                _set_questions_cache(questions, datetime.now())
+        except Exception as e:
+            print(f'⚠️  背景刷新題目失敗: {str(e)}')
+        finally:
+            questions_refresh_in_flight = False
+    
+    threading.Thread(target=worker, daemon=True).start()
+
 @app.route('/api/questions', methods=['GET'])
 def get_questions():
     """
     獲取所有題目列表
     支援快取機制
     """
-    global questions_cache, questions_last_fetch
-    
     try:
         # 檢查快取是否有效
         now = datetime.now()
-        if questions_cache and questions_last_fetch:
-            time_diff = (now - questions_last_fetch).total_seconds() / 60
-            if time_diff < CACHE_EXPIRE_MINUTES:
+        # 取得目前快取的參考，之後即使被背景刷新替換也不影響本次回應
+        cached, last_fetch = questions_cache, questions_last_fetch
+        if cached and last_fetch:
+            time_diff = (now - last_fetch).total_seconds() / 60
+            if time_diff < CACHE_EXPIRE_MINUTES * 2:
+                # 即將過期或已過期但未超過兩倍時間：先回傳目前資料，背景刷新，不讓使用者等待
+                if time_diff >= CACHE_EXPIRE_MINUTES * CACHE_PREFETCH_RATIO:
+                    refresh_questions_in_background()
                 return jsonify({
                     'success': True,
-                    'questions': questions_cache,
+                    'questions': cached,
                     'cached': True,
                     'cache_age_minutes': round(time_diff, 1)
                 })
@@ -1106,8 +1444,7 @@ def get_questions():
         questions = fetch_questions_from_sheet()
         
         if questions:
-            questions_cache = questions
-            questions_last_fetch = now
+            _set_questions_cache(questions, now)
             return jsonify({
                 'success': True,
                 'questions': questions,
@@ -1116,13 +1453,12 @@ def get_questions():
         else:
             # 如果讀取失敗，嘗試從本地 JSON 讀取
             if os.path.exists('questions.json'):
-                with open('questions.json', 'r', encoding='utf-8') as f:
-                    questions = json.load(f)
-                    return jsonify({
-                        'success': True,
-                        'questions': questions,
-                        'from_file': True
-                    })
+                questions = load_json_file('questions.json')
+                return jsonify({
+                    'success': True,
+                    'questions': questions,
+                    'from_file': True
+                })
             else:
                 return jsonify({
                     'success': False,
@@ -1142,15 +1478,12 @@ def get_question_by_id(question_id):
     """
     try:
         # 先獲取所有題目
-        global questions_cache
-        
         if not questions_cache:
             questions = fetch_questions_from_sheet()
             if questions:
-                questions_cache = questions
+                _set_questions_cache(questions)
             elif os.path.exists('questions.json'):
-                with open('questions.json', 'r', encoding='utf-8') as f:
-                    questions_cache = json.load(f)
+                _set_questions_cache(load_json_file('questions.json'))
         
         if not questions_cache:
             return jsonify({
@@ -1159,11 +1492,7 @@ def get_question_by_id(question_id):
             })
         
         # 查找指定 ID 的題目
-        question = None
-        for q in questions_cache:
-            if str(q.get('id')) == str(question_id):
-                question = q
-                break
+        question = questions_by_id.get(str(question_id))
         
         if question:
             return jsonify({
@@ -1187,18 +1516,14 @@ def refresh_questions():
     """
     強制重新從 Google Sheets 載入題目
     """
-    global questions_cache, questions_last_fetch
-    
     try:
         questions = fetch_questions_from_sheet()
         
         if questions:
-            questions_cache = questions
-            questions_last_fetch = datetime.now()
+            _set_questions_cache(questions, datetime.now())
             
             # 同時儲存到本地
-            with open('questions.json', 'w', encoding='utf-8') as f:
-                json.dump(questions, f, ensure_ascii=False, indent=2)
+            save_questions_to_file(questions)
             
             return jsonify({
                 'success': True,
@@ -1269,9 +1594,22 @@ def submit_score():
 def get_student_scores(student_name):
     """
     獲取學生的所有成績
+    選用查詢參數：limit、offset（分頁）、fields（只回傳指定欄位，以逗號分隔，例如 fields=question_id,score）
     """
     try:
-        scores = fetch_student_scores(student_name)
+        # 無效或負數的 limit / offset 沿用預設值（不限筆數、從頭開始）
+        limit = request.args.get('limit', type=int)
+        if limit is not None and limit < 0:
+            limit = None
+        offset = max(request.args.get('offset', 0, type=int), 0)
+        fields = [field.strip() for field in request.args.get('fields', '').split(',') if field.strip()]
+        
+        scores = fetch_student_scores(
+            student_name,
+            limit=limit,
+            offset=offset,
+            fields=fields or None
+        )
         
         if scores is not None:
             return jsonify({
@@ -1291,205 +1629,325 @@ def get_student_scores(student_name):
             'error': f'讀取失敗: {str(e)}'
         })
 
+# 成績本地備份：啟動時載入記憶體，讀取直接使用記憶體資料，寫檔以計時器合併
+SCORES_FILE = 'scores_backup.jsonl'  # 每行一筆成績紀錄，更新時只追加一行
+LEGACY_SCORES_FILE = 'scores_backup.json'  # 舊版整份 JSON 陣列，找不到 JSONL 時轉換一次
+SCORES_SAVE_DELAY = 2  # 最後一次更新後幾秒寫回檔案
+SCORES_COMPACT_RATIO = 2  # 檔案行數超過不重複紀錄數的幾倍時整份重寫
+scores_data = []  # 所有成績紀錄（保持檔案中的順序）
+_scores_by_student = {}  # {student_name: {question_id: record}}，每位學生每題只保留最高分
+scores_lock = threading.Lock()
+_scores_io_lock = threading.Lock()  # 檔案寫入鎖（追加與重寫不可交錯），不可在持有 scores_lock 時取得
+_scores_save_timer = None
+_scores_pending = []  # 尚未寫入檔案的紀錄（已序列化的 JSONL 行）
+_scores_log_lines = 0  # 成績檔目前的行數
+
+def _read_scores_log():
+    """
+    逐行讀取 scores_backup.jsonl，返回 (紀錄列表, 行數, 是否有損壞的行)
+    無法解析的行（例如寫到一半中斷）略過
+    """
+    parse = orjson.loads if orjson is not None else json.loads
+    records = []
+    line_count = 0
+    damaged = False
+    with open(SCORES_FILE, 'rb') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            line_count += 1
+            try:
+                records.append(parse(line))
+            except ValueError:
+                damaged = True
+                logger.warning('⚠️  略過無法解析的成績紀錄（第 %d 行）', line_count)
+    return records, line_count, damaged
+
+def _is_score_record(record):
+    """
+    檢查一筆紀錄是否具備合併所需的欄位（學生姓名、題目 ID、數值分數）
+    """
+    return (
+        isinstance(record, dict)
+        and isinstance(record.get('student_name'), (str, int))
+        and isinstance(record.get('question_id'), (str, int))
+        and isinstance(record.get('score'), (int, float))
+    )
+
+def load_scores_backup():
+    """
+    從 scores_backup.jsonl 載入成績並建立學生索引（只有舊版 scores_backup.json 時轉換成 JSONL）
+    同一學生同一題若有多筆紀錄，合併為最高分的一筆（位置沿用第一筆）
+    """
+    global scores_data, _scores_by_student, _scores_log_lines
+    
+    records = []
+    line_count = 0
+    damaged = migrate = False
+    try:
+        if os.path.exists(SCORES_FILE):
+            records, line_count, damaged = _read_scores_log()
+        elif os.path.exists(LEGACY_SCORES_FILE):
+            legacy = load_json_file(LEGACY_SCORES_FILE)
+            if not isinstance(legacy, list):
+                raise ValueError(f'{LEGACY_SCORES_FILE} 不是成績紀錄陣列')
+            records = legacy
+            migrate = True
+    except Exception as e:
+        logger.warning('⚠️  無法載入成績備份: %s', e)
+    
+    kept = []
+    by_student = {}
+    for record in records:
+        # JSON 格式正確但欄位不符的紀錄同樣略過，並在之後重寫檔案
+        if not _is_score_record(record):
+            damaged = True
+            logger.warning('⚠️  略過格式不符的成績紀錄: %.80r', record)
+            continue
+        per_question = by_student.setdefault(record['student_name'], {})
+        existing = per_question.get(record['question_id'])
+        if existing is None:
+            per_question[record['question_id']] = record
+            kept.append(record)
+        elif record['score'] > existing['score']:
+            existing.update(record)
+    
+    with scores_lock:
+        scores_data = kept
+        _scores_by_student = by_student
+        _scores_log_lines = line_count
+    
+    # 轉換舊版檔案，或重寫掉損壞的行（避免之後追加的紀錄接在不完整的行後面）
+    if migrate or damaged:
+        _save_scores_backup(compact=True)
+    if migrate:
+        logger.info('📦 已將 %s 轉換為 %s（%d 筆）', LEGACY_SCORES_FILE, SCORES_FILE, len(kept))
+
+def _save_scores_backup(compact=False):
+    """
+    將累積的成績更新追加到 scores_backup.jsonl
+    重複的舊紀錄行數過多（或 compact=True）時改為整份重寫（先寫暫存檔再取代，避免寫到一半被讀到）
+    """
+    global _scores_save_timer, _scores_pending, _scores_log_lines
+    
+    with _scores_io_lock:
+        with scores_lock:
+            _scores_save_timer = None
+            pending, _scores_pending = _scores_pending, []
+            if not pending and not compact:
+                return
+            compact = compact or _scores_log_lines + len(pending) > SCORES_COMPACT_RATIO * len(scores_data)
+            if compact:
+                content = b''.join(dump_json_line(record) for record in scores_data)
+                line_count = len(scores_data)
+            else:
+                content = b''.join(pending)
+                line_count = _scores_log_lines + len(pending)
+        
+        try:
+            if compact:
+                tmp_file = SCORES_FILE + '.tmp'
+                with open(tmp_file, 'wb') as f:
+                    f.write(content)
+                os.replace(tmp_file, SCORES_FILE)
+            else:
+                with open(SCORES_FILE, 'ab') as f:
+                    f.write(content)
+        except Exception as e:
+            logger.error('❌ 寫入成績備份失敗: %s', e)
+            # 放回待寫清單，下次存檔時再寫
+            with scores_lock:
+                _scores_pending[:0] = pending
+            return
+        
+        _scores_log_lines = line_count
+
+def _schedule_scores_save():
+    """
+    安排延遲寫檔，短時間內的多次更新只寫一次（呼叫時需持有 scores_lock）
+    """
+    global _scores_save_timer
+    
+    if _scores_save_timer is None:
+        _scores_save_timer = threading.Timer(SCORES_SAVE_DELAY, _save_scores_backup)
+        _scores_save_timer.daemon = True
+        _scores_save_timer.start()
+
+def _queue_score_record(record):
+    """
+    記下一筆新增或更新的成績，稍後追加到檔案（呼叫時需持有 scores_lock）
+    """
+    _scores_pending.append(dump_json_line(record))
+    _schedule_scores_save()
+
+def flush_scores_backup():
+    """
+    立即寫入尚未存檔的成績（程式結束時呼叫）
+    """
+    with scores_lock:
+        timer = _scores_save_timer
+    if timer is not None:
+        timer.cancel()
+    _save_scores_backup()
+
+load_scores_backup()
+atexit.register(flush_scores_backup)
+
+# 詳細評分的欄位（順序即成績表中的欄位順序）
+_DETAIL_KEYS = ('time_complexity', 'space_complexity', 'readability', 'stability')
+
+def _extract_detailed(detailed_scores):
+    """
+    取出詳細評分，返回 (時間複雜度, 空間複雜度, 可讀性, 穩定性)，缺少的項目為 0
+    """
+    if not detailed_scores:
+        return (0, 0, 0, 0)
+    return tuple(detailed_scores.get(key, 0) for key in _DETAIL_KEYS)
+
 def update_score_in_sheet(student_name, question_id, score, code, timestamp, detailed_scores=None):
     """
     更新 Google Sheets 中的成績（保留最高分，包含詳細評分）
-    使用 CSV 導出和 HTTP POST 方式
+    以本地備份判斷是否已有較高分數，不必下載整份成績表 CSV
     """
     try:
-        import requests
-        import csv
-        from io import StringIO
-        
-        # 1. 讀取現有資料
-        response = requests.get(SCORES_SHEET_URL, timeout=10)
-        response.encoding = 'utf-8'
-        
-        if response.status_code != 200:
-            print(f"❌ 無法讀取成績表: HTTP {response.status_code}")
-            # 如果無法讀取，嘗試直接寫入（使用 Google Apps Script Web App）
-            return write_score_via_webapp(student_name, question_id, score, code, timestamp, detailed_scores)
-        
-        # 2. 解析 CSV
-        csv_data = StringIO(response.text)
-        reader = csv.reader(csv_data)
-        rows = list(reader)
-        
-        if len(rows) == 0:
-            # 空表格，創建標題行
-            rows = [['學生姓名', '題目ID', '題目標題', '總分', '時間複雜度', '空間複雜度', '易讀性', '穩定性', '提交時間', '程式碼']]
-        
-        # 3. 查找該學生該題目的現有記錄
-        updated = False
-        for i, row in enumerate(rows[1:], start=1):  # 跳過標題行
-            if len(row) >= 2 and row[0] == student_name and row[1] == question_id:
-                # 找到現有記錄，比較分數
-                existing_score = int(row[3]) if len(row) > 3 and row[3].isdigit() else 0
-                if score > existing_score:
-                    # 更新為更高的分數
-                    time_score = detailed_scores.get('time_complexity', 0) if detailed_scores else 0
-                    space_score = detailed_scores.get('space_complexity', 0) if detailed_scores else 0
-                    read_score = detailed_scores.get('readability', 0) if detailed_scores else 0
-                    stab_score = detailed_scores.get('stability', 0) if detailed_scores else 0
-                    
-                    rows[i] = [student_name, question_id, get_question_title(question_id), 
-                              str(score), str(time_score), str(space_score), str(read_score), str(stab_score),
-                              timestamp, code[:100]]
-                    updated = True
-                    print(f"✅ 更新成績: {student_name} - 題目 {question_id}: {existing_score} -> {score}")
-                else:
-                    print(f"ℹ️  保留較高分數: {student_name} - 題目 {question_id}: {existing_score}")
-                    return True
-                break
-        
-        # 4. 如果沒有找到記錄，新增一行
-        if not updated:
-            time_score = detailed_scores.get('time_complexity', 0) if detailed_scores else 0
-            space_score = detailed_scores.get('space_complexity', 0) if detailed_scores else 0
-            read_score = detailed_scores.get('readability', 0) if detailed_scores else 0
-            stab_score = detailed_scores.get('stability', 0) if detailed_scores else 0
-            
-            rows.append([student_name, question_id, get_question_title(question_id), 
-                        str(score), str(time_score), str(space_score), str(read_score), str(stab_score),
-                        timestamp, code[:100]])
-            print(f"✅ 新增成績: {student_name} - 題目 {question_id}: {score}")
+        with scores_lock:
+            existing = _scores_by_student.get(student_name, {}).get(question_id)
+            existing_score = existing['score'] if existing else None
         
-        # 5. 寫回 Google Sheets（使用 Web App 端點）
+        if existing_score is not None and score <= existing_score:
+            logger.info("ℹ️  保留較高分數: %s - 題目 %s: %s", student_name, question_id, existing_score)
+            return True
+        
+        # 寫入 Google Sheets（使用 Web App 端點）並更新本地備份
         return write_score_via_webapp(student_name, question_id, score, code, timestamp, detailed_scores)
         
     except Exception as e:
-        print(f"❌ 更新成績失敗: {str(e)}")
+        logger.error("❌ 更新成績失敗: %s", e)
         return False
 
+def _post_score_to_webapp(payload, student_name, question_id, score):
+    """
+    將一筆成績 POST 到 Google Apps Script Web App（在 _IO_POOL 中執行，錯誤只記錄不拋出）
+    """
+    try:
+        response = http_session.post(
+            WEBAPP_URL,
+            json=payload,
+            timeout=10
+        )
+        
+        if response.status_code == 200:
+            result = response.json()
+            if result.get('success'):
+                logger.info("✅ 成績已寫入 Google Sheets: %s - 題目 %s: %s", student_name, question_id, score)
+            else:
+                logger.warning("⚠️ Google Sheets 寫入失敗: %s", result.get('message', '未知錯誤'))
+        else:
+            logger.warning("⚠️ Google Sheets HTTP 錯誤: %s", response.status_code)
+    
+    except Exception as sheet_error:
+        logger.warning("⚠️ 無法寫入 Google Sheets: %s", sheet_error)
+
 def write_score_via_webapp(student_name, question_id, score, code, timestamp, detailed_scores=None):
     """
     通過 Google Apps Script Web App 寫入成績到 Google Sheets（包含詳細評分）
     同時備份到本地 JSON
     """
     try:
-        import requests
-        
         # 準備詳細評分
-        time_score = detailed_scores.get('time_complexity', 0) if detailed_scores else 0
-        space_score = detailed_scores.get('space_complexity', 0) if detailed_scores else 0
-        read_score = detailed_scores.get('readability', 0) if detailed_scores else 0
-        stab_score = detailed_scores.get('stability', 0) if detailed_scores else 0
+        time_score, space_score, read_score, stab_score = _extract_detailed(detailed_scores)
         question_title = get_question_title(question_id)
+        code_preview = code[:100]  # 只保存前100字元（Sheets 與本地備份共用）
+        
+        # 1. 在背景寫入 Google Sheets（分數欄位以字串寫入，一次轉換）
+        payload = {
+            'action': 'appendRow',
+            'data': [
+                student_name,
+                question_id,
+                question_title,
+                *map(str, (score, time_score, space_score, read_score, stab_score)),
+                timestamp,
+                code_preview
+            ]
+        }
+        sheets_future = _IO_POOL.submit(_post_score_to_webapp, payload, student_name, question_id, score)
         
-        # 1. 嘗試寫入 Google Sheets
-        try:
-            payload = {
-                'action': 'appendRow',
-                'data': [
-                    student_name,
-                    question_id,
-                    question_title,
-                    str(score),
-                    str(time_score),
-                    str(space_score),
-                    str(read_score),
-                    str(stab_score),
-                    timestamp,
-                    code[:100]  # 只保存前100字元
-                ]
-            }
-            
-            response = requests.post(
-                WEBAPP_URL,
-                json=payload,
-                timeout=10
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                if result.get('success'):
-                    print(f"✅ 成績已寫入 Google Sheets: {student_name} - 題目 {question_id}: {score}")
-                else:
-                    print(f"⚠️ Google Sheets 寫入失敗: {result.get('message', '未知錯誤')}")
-            else:
-                print(f"⚠️ Google Sheets HTTP 錯誤: {response.status_code}")
-        
-        except Exception as sheet_error:
-            print(f"⚠️ 無法寫入 Google Sheets: {str(sheet_error)}")
-        
-        # 2. 備份到本地 JSON（無論 Google Sheets 是否成功）
-        scores_file = 'scores_backup.json'
-        scores_data = []
-        
-        if os.path.exists(scores_file):
-            with open(scores_file, 'r', encoding='utf-8') as f:
-                scores_data = json.load(f)
-        
-        # 查找並更新或新增
-        found = False
-        for record in scores_data:
-            if record['student_name'] == student_name and record['question_id'] == question_id:
+        # 2. 備份到本地（無論 Google Sheets 是否成功），先更新記憶體，稍後再寫檔
+        with scores_lock:
+            # 查找並更新或新增
+            record = _scores_by_student.get(student_name, {}).get(question_id)
+            if record is not None:
                 if score > record['score']:
                     record['score'] = score
                     record['timestamp'] = timestamp
-                    record['code'] = code[:100]
+                    record['code'] = code_preview
                     record['time_complexity_score'] = time_score
                     record['space_complexity_score'] = space_score
                     record['readability_score'] = read_score
                     record['stability_score'] = stab_score
-                    print(f"📝 本地備份已更新: {student_name} - 題目 {question_id}")
-                found = True
-                break
-        
-        if not found:
-            new_record = {
-                'student_name': student_name,
-                'question_id': question_id,
-                'question_title': question_title,
-                'score': score,
-                'time_complexity_score': time_score,
-                'space_complexity_score': space_score,
-                'readability_score': read_score,
-                'stability_score': stab_score,
-                'timestamp': timestamp,
-                'code': code[:100]
-            }
-            scores_data.append(new_record)
-            print(f"📝 本地備份已新增: {student_name} - 題目 {question_id}")
+                    logger.info("📝 本地備份已更新: %s - 題目 %s", student_name, question_id)
+                    _queue_score_record(record)
+            else:
+                new_record = {
+                    'student_name': student_name,
+                    'question_id': question_id,
+                    'question_title': question_title,
+                    'score': score,
+                    'time_complexity_score': time_score,
+                    'space_complexity_score': space_score,
+                    'readability_score': read_score,
+                    'stability_score': stab_score,
+                    'timestamp': timestamp,
+                    'code': code_preview
+                }
+                scores_data.append(new_record)
+                _scores_by_student.setdefault(student_name, {})[question_id] = new_record
+                logger.info("📝 本地備份已新增: %s - 題目 %s", student_name, question_id)
+                _queue_score_record(new_record)
         
-        with open(scores_file, 'w', encoding='utf-8') as f:
-            json.dump(scores_data, f, ensure_ascii=False, indent=2)
+        # 3. 等待 Google Sheets 寫入完成（逾時只停止等待，請求仍在背景完成）
+        try:
+            sheets_future.result(timeout=WEBAPP_JOIN_TIMEOUT)
+        except FutureTimeoutError:
+            logger.warning("⚠️ Google Sheets 寫入逾時，改在背景完成: %s - 題目 %s", student_name, question_id)
         
         return True
         
     except Exception as e:
-        print(f"❌ 寫入成績失敗: {str(e)}")
+        logger.error("❌ 寫入成績失敗: %s", e)
         return False
 
-def fetch_student_scores(student_name):
+def fetch_student_scores(student_name, limit=None, offset=0, fields=None):
     """
-    獲取學生的所有成績
+    獲取學生的所有成績（每題一筆，依第一次提交的順序）
+    limit / offset: 只取其中一段；fields: 只保留這些欄位（不存在的欄位略過）
     """
     try:
-        # 先嘗試從本地備份讀取
-        scores_file = 'scores_backup.json'
-        if os.path.exists(scores_file):
-            with open(scores_file, 'r', encoding='utf-8') as f:
-                all_scores = json.load(f)
-                student_scores = [s for s in all_scores if s['student_name'] == student_name]
-                return student_scores
-        
-        return []
+        # 從記憶體中的本地備份讀取（複製一份，避免回傳途中被更新）
+        with scores_lock:
+            records = _scores_by_student.get(student_name, {}).values()
+            end = offset + limit if limit is not None else None
+            selected = itertools.islice(records, offset, end)
+            if fields:
+                return [{key: record[key] for key in fields if key in record} for record in selected]
+            return [dict(record) for record in selected]
         
     except Exception as e:
-        print(f"❌ 讀取成績失敗: {str(e)}")
+        logger.error("❌ 讀取成績失敗: %s", e)
         return None
 
 def get_question_title(question_id):
     """
-    根據題目 ID 獲取題目標題
+    根據題目 ID 獲取題目標題（以題目快取版本作為快取鍵的一部分，題目更新後自動失效）
     """
-    global questions_cache
-    
-    if questions_cache:
-        for q in questions_cache:
-            if str(q.get('id')) == str(question_id):
-                return q.get('title', f'題目 {question_id}')
+    return _get_question_title_cached(str(question_id), _questions_version)
+
+@functools.lru_cache(maxsize=256)
+def _get_question_title_cached(question_id, version):
+    q = questions_by_id.get(question_id)
+    if q:
+        return q.get('title', f'題目 {question_id}')
     
     return f'題目 {question_id}'
 
@@ -1553,10 +2011,9 @@ def health_check():
         'timestamp': datetime.now().isoformat()
     })
 
-@app.route('/', methods=['GET'])
-def index():
-    """根路徑"""
-    return jsonify({
+def build_index_payload():
+    """根路徑回傳的服務資訊（API Keys 只在啟動時載入，內容不會再變）"""
+    return {
         'service': 'Python 智能程式診斷平台 - 安全後端 API',
         'version': '3.2.0',
         'status': 'running',
@@ -1592,7 +2049,15 @@ def index():
             'auto_start': '/api/auto_start (POST) - 自動啟動確認',
             'health': '/health (GET) - 健康檢查'
         }
-    })
+    }
+
+# 啟動時先序列化好根路徑的回應內容，每次請求只需包成新的 Response
+_INDEX_JSON = app.json.dumps(build_index_payload()).encode('utf-8')
+
+@app.route('/', methods=['GET'])
+def index():
+    """根路徑"""
+    return app.response_class(_INDEX_JSON, mimetype='application/json')
 
 if __name__ == '__main__':
     print('=' * 60)
@@ -0,0 +1,91 @@
+"""
+程式碼安全檢查的走訪順序測試
+確認 _find_safety_violation 在有多個違規時，回報的錯誤與原本以 ast.walk 逐一檢查的結果相同
+"""
+
+import ast
+import itertools
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+
+
+def reference_violation(code):
+    """原本的檢查方式：依 ast.walk 的順序逐一檢查節點，回傳第一個違規"""
+    for node in ast.walk(ast.parse(code)):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                if alias.name not in server.ALLOWED_MODULES:
+                    return f"不允許導入模組: {alias.name}"
+        elif isinstance(node, ast.ImportFrom):
+            if node.module and node.module not in server.ALLOWED_MODULES:
+                return f"不允許導入模組: {node.module}"
+        elif type(node) in server.DANGEROUS_NODES:
+            return f"不允許使用: {type(node).__name__}"
+        elif isinstance(node, ast.Call):
+            if isinstance(node.func, ast.Name) and node.func.id in server.DANGEROUS_FUNCTIONS:
+                return f"不允許使用函數: {node.func.id}"
+        elif isinstance(node, ast.Attribute):
+            if node.attr in server.DANGEROUS_ATTRS:
+                return f"不允許存取屬性: {node.attr}"
+    return None
+
+
+# 各種違規的單行語句
+VIOLATIONS = [
+    'import os',
+    'from subprocess import run',
+    'eval("1")',
+    'x = [open("f")]',
+    'y = f.__globals__',
+    'print(len(dir()))',
+    'global g',
+]
+
+# 把語句放到不同深度的包裝
+WRAPPERS = [
+    '{}',
+    'if True:\n    {}',
+    'def f():\n    {}',
+    'for i in range(3):\n    if i:\n        {}',
+]
+
+# 手寫的多重違規範例
+SAMPLES = [
+    '[eval(1)]\nimport os',
+    'def f():\n    exec("x")\nimport sys',
+    'print(vars(), a.__builtins__)',
+    'x = [[[eval(1)]], open("f")]',
+    'def f():\n    def g():\n        nonlocal x\n    global y',
+    'import math, os, sys',
+]
+
+
+class FindSafetyViolationOrderTest(unittest.TestCase):
+
+    def assert_same_as_walk(self, code):
+        with self.subTest(code=code):
+            self.assertEqual(server._find_safety_violation(ast.parse(code)), reference_violation(code))
+
+    def test_reports_breadth_first_violation(self):
+        self.assertEqual(server._find_safety_violation(ast.parse('[eval(1)]\nimport os')), '不允許導入模組: os')
+
+    def test_handwritten_samples(self):
+        for code in SAMPLES:
+            self.assert_same_as_walk(code)
+
+    def test_generated_multi_violation_samples(self):
+        for first, second in itertools.permutations(VIOLATIONS, 2):
+            for wrap_first, wrap_second in itertools.product(WRAPPERS, repeat=2):
+                self.assert_same_as_walk(wrap_first.format(first) + '\n' + wrap_second.format(second))
+
+    def test_safe_code(self):
+        self.assert_same_as_walk('import math\nprint(sum(int(x) for x in input().split()))')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,14 +5,14 @@
 import ast
 
 # 從 server.py 讀取配置
-DANGEROUS_FUNCTIONS = {
+DANGEROUS_FUNCTIONS = frozenset({
     'open', 'file', 'raw_input',  # input 已移除
     'exec', 'eval', 'compile',
     'globals', 'locals', 'vars', 'dir',
     'setattr', 'delattr',
     'exit', 'quit', 'help', 'license', 'credits',
     'reload', 'execfile'
-}
+})
 
 # 測試程式碼
 test_code = """
@@ -20,6 +20,18 @@ name = input("請輸入名字: ")
 print(f"你好, {name}!")
 """
 
+class _FoundViolation(Exception):
+    """找到第一個違規時中止走訪"""
+
+class _SafetyVisitor(ast.NodeVisitor):
+    """只在函數調用節點做檢查，其餘節點由 generic_visit 直接往下走"""
+    
+    def visit_Call(self, node):
+        func = node.func
+        if isinstance(func, ast.Name) and func.id in DANGEROUS_FUNCTIONS:
+            raise _FoundViolation(func.id)
+        self.generic_visit(node)
+
 def validate_code_safety(code):
     """檢查程式碼是否安全"""
     try:
@@ -27,13 +39,10 @@ def validate_code_safety(code):
     except SyntaxError as e:
         return False, f"語法錯誤: {str(e)}"
     
-    for node in ast.walk(tree):
-        # 檢查函數調用
-        if isinstance(node, ast.Call):
-            if isinstance(node.func, ast.Name):
-                func_name = node.func.id
-                if func_name in DANGEROUS_FUNCTIONS:
-                    return False, f"不允許使用函數: {func_name}"
+    try:
+        _SafetyVisitor().visit(tree)
+    except _FoundViolation as violation:
+        return False, f"不允許使用函數: {violation.args[0]}"
     
     return True, None
 
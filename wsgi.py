@@ -0,0 +1,9 @@
+"""
+WSGI 進入點（正式部署用）
+以 gunicorn 啟動：gunicorn -k gthread -w 1 --threads 32 -b 0.0.0.0:5000 wsgi:application
+"""
+
+from server import app
+
+# WSGI 伺服器預設尋找的名稱
+application = app